@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+from urllib import parse
+
+from aiohttp import web
+from multidict import MultiDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import coroweb
+from apis import APIError
+
+""" requests/sec of RequestHandler argument binding per handler shape, before and after precompiled binder """
+
+
+class LegacyRequestHandler(coroweb.RequestHandler):
+    """
+    RequestHandler.__call__ before precompiled binder, verbatim
+    """
+
+    def __init__(self, app, fn):
+        super().__init__(app, fn)
+        self._has_request_args = coroweb.has_request_args(fn)
+        self._has_var_kw_arg = coroweb.has_var_kw_arg(fn)
+        self._has_named_kw_args = coroweb.has_named_kw_args(fn)
+        self._named_kw_args = coroweb.get_named_kw_args(fn)
+        self._required_kw_args = coroweb.get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+            if request.method == "POST":
+                ct = request.content_type
+                if not ct:
+                    return web.HTTPBadRequest("Missing Content-Type.")
+                ct = ct.lower()
+                if ct.startswith("application/json"):
+                    params = await request.json()
+                    if not isinstance(params, dict):
+                        return web.HTTPBadRequest("JSON body must be object.")
+                    kw = params
+                elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
+                    params = await request.post()
+                    kw = dict(**params)
+                else:
+                    return web.HTTPBadRequest("Unsupported Content-Type: %s" % ct)
+            elif request.method == "GET":
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                if k in kw:
+                    logging.warning("Duplicate arg in named arg and kw args: %s" % k)
+                kw[k] = v
+        if self._has_request_args:
+            kw["request"] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if name not in kw:
+                    return web.HTTPBadRequest("Missing required argument: %s" % name)
+        logging.info("Call with args: %s" % str(kw))
+        try:
+            r = await self._func(**kw)
+            return r
+        except APIError as e:
+            return dict(error=e.error, data=e.data, message=e.message)
+
+
+class BenchRequest(object):
+    """
+    Minimal GET request, parses query once per request like aiohttp
+    """
+
+    def __init__(self, url, match_info):
+        self.method = "GET"
+        self.path, _, self.query_string = url.partition("?")
+        self.match_info = match_info
+        self._query = None
+
+    @property
+    def query(self):
+        if self._query is None:
+            self._query = MultiDict(parse.parse_qsl(self.query_string, True))
+        return self._query
+
+
+async def no_args():
+    return "ok"
+
+
+async def named_args(*, page="1", size="20"):
+    return int(page) + int(size)
+
+
+async def typed_args(id, *, page: int = 1, size: int = 20, tags: list = ()):
+    return page + size
+
+
+async def var_kw_args(**kw):
+    return kw
+
+
+SHAPES = (
+    ("no_args", no_args, "/", {}),
+    ("named_args", named_args, "/?page=2&size=10&other=1", {}),
+    ("typed_args", typed_args, "/blog/1?page=2&size=10&tags=a&tags=b", {"id": "1"}),
+    ("var_kw_args", var_kw_args, "/?a=1&b=2&c=3", {}),
+)
+
+
+async def rps(handler, requests):
+    start = time.perf_counter()
+    for request in requests:
+        await handler(request)
+    return len(requests) / (time.perf_counter() - start)
+
+
+async def run(number=50000, rounds=7):
+    for name, fn, url, match_info in SHAPES:
+        legacy, handler = LegacyRequestHandler(None, fn), coroweb.RequestHandler(None, fn)
+        before = after = 0
+        # rounds alternate between handlers, best of each; fresh requests, parsed query is cached on request
+        for _ in range(rounds):
+            before = max(before, await rps(legacy, [BenchRequest(url, match_info) for _ in range(number)]))
+            after = max(after, await rps(handler, [BenchRequest(url, match_info) for _ in range(number)]))
+        print("%-12s before %9.0f req/s  after %9.0f req/s  %+6.1f%%" % (name, before, after,
+                                                                        (after - before) / before * 100))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run())
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import coroweb
+
+""" resolves/sec of aiohttp UrlDispatcher and coroweb.Router with static fast path, per route table size """
+
+
+async def handler(request):
+    return web.Response()
+
+
+def build(router, size):
+    app = web.Application(router=router)
+    for i in range(size):
+        app.router.add_route("GET", "/static%s/page" % i, handler)
+        app.router.add_route("GET", "/dynamic%s/{id}" % i, handler)
+    app.freeze()
+    return app
+
+
+async def rps(router, requests, number):
+    start = time.perf_counter()
+    for _ in range(number // len(requests)):
+        for request in requests:
+            await router.resolve(request)
+    return number / (time.perf_counter() - start)
+
+
+async def run(sizes=(10, 100, 1000), number=100000, rounds=5):
+    for size in sizes:
+        paths = {
+            "static": ["/static%s/page" % i for i in range(0, size, max(1, size // 10))],
+            "dynamic": ["/dynamic%s/42" % i for i in range(0, size, max(1, size // 10))],
+        }
+        stock, compiled = build(web.UrlDispatcher(), size).router, build(coroweb.Router(), size).router
+        for kind, urls in paths.items():
+            requests = [make_mocked_request("GET", url) for url in urls]
+            # warm up both, then rounds alternate between routers, best of each
+            await rps(stock, requests, number)
+            await rps(compiled, requests, number)
+            before = after = 0
+            for _ in range(rounds):
+                before = max(before, await rps(stock, requests, number))
+                after = max(after, await rps(compiled, requests, number))
+            print("%5d routes %-8s before %9.0f resolves/s  after %9.0f resolves/s  %+6.1f%%" % (
+                size, kind, before, after, (after - before) / before * 100))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run())
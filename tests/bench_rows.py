@@ -0,0 +1,89 @@
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import orm
+from models import Comment
+
+""" memory and speed of materialising rows as models, slots rows and tuples """
+
+COLUMNS = (Comment.__primary_key__,) + tuple(Comment.__fields__)
+
+
+def fetch_tuples(n):
+    """
+    rows as a tuple cursor returns them
+    """
+    return [tuple("%s-%s" % (c, i) if c != "create_at" else i for c in COLUMNS) for i in range(n)]
+
+
+def fetch_dicts(n):
+    """
+    rows as a dict cursor returns them
+    """
+    return [dict(zip(COLUMNS, r)) for r in fetch_tuples(n)]
+
+
+def as_models(rows):
+    return [Comment(**r) for r in rows]
+
+
+def as_slots(rows):
+    row_class = orm._row_class(Comment, COLUMNS)
+    return [row_class(*r) for r in rows]
+
+
+def as_tuples(rows):
+    return [r for r in rows]
+
+
+CASES = (("model", fetch_dicts, as_models), ("slots", fetch_tuples, as_slots), ("tuple", fetch_tuples, as_tuples))
+
+
+def measure_time(fetch, fn, n, rounds=5):
+    """
+    best conversion time of the fetched rows, without tracing
+    """
+    best = None
+    for _ in range(rounds):
+        rows = fetch(n)
+        gc.collect()
+        start = time.perf_counter()
+        objs = fn(rows)
+        cost = time.perf_counter() - start
+        assert len(objs) == n
+        best = cost if best is None else min(best, cost)
+        del rows, objs
+    return best
+
+
+def measure_memory(fetch, fn, n):
+    """
+    memory kept by the converted rows, the fetched rows included when they are kept
+    """
+    gc.collect()
+    tracemalloc.start()
+    rows = fetch(n)
+    objs = fn(rows)
+    del rows
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(objs) == n
+    return size
+
+
+def run(n=50000):
+    for name, fetch, fn in CASES:
+        fn(fetch(100))
+        cost = measure_time(fetch, fn, n)
+        size = measure_memory(fetch, fn, n)
+        print("%-6s %8.1f ms %8.1f MB  (%d rows)" % (name, cost * 1000, size / 1024 / 1024, n))
+
+
+if __name__ == "__main__":
+    run()
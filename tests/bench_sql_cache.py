@@ -0,0 +1,41 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import orm
+from models import Comment
+
+""" per query cpu cost of building and translating find_all/get_count statements """
+
+
+def uncached_find_all(where, order_by, limit):
+    sql = [Comment.__select__]
+    if where:
+        sql.append("WHERE")
+        sql.append(where)
+    if order_by:
+        sql.append("ORDER BY")
+        sql.append(order_by)
+    if limit:
+        sql.append("LIMIT")
+        sql.append("?, ?")
+    return " ".join(sql).replace("?", "%s")
+
+
+def cached_find_all(where, order_by, limit):
+    return orm._translate(orm._find_all_sql(Comment, where, order_by, 2 if limit else None))
+
+
+def run(number=200000):
+    shape = ("`blog_id`=?", "`create_at` desc", (0, 20))
+    for name, fn in (("uncached", uncached_find_all), ("cached", cached_find_all)):
+        assert fn(*shape) == uncached_find_all(*shape)
+        cost = timeit.timeit(lambda: fn(*shape), number=number)
+        print("%-8s %8.3f us/query" % (name, cost / number * 1e6))
+    print(orm.statement_cache_info())
+
+
+if __name__ == "__main__":
+    run()
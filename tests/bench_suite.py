@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS, "..", "www"))
+
+import app
+import coroweb
+import orm
+from coroweb import url_route
+from models import User
+
+import bench_handler
+import fake_aiomysql
+import load_test
+
+""" end-to-end benchmarks of orm and coroweb on an embedded sqlite database, a local MySQL, or a fake aiomysql stub
+    without sql at all, results stored as json.
+    python bench_suite.py --output new.json --compare old.json """
+
+ROW_COUNTS = (10, 100, 1000, 10000)
+BACKENDS = ("sqlite", "mysql", "stub")
+
+
+@url_route("/bench/json")
+async def bench_json():
+    return dict(users=await User.find_all(limit=20))
+
+
+@url_route("/bench/html")
+async def bench_html():
+    return {"__template__": "test.html", "users": await User.find_all(limit=20)}
+
+
+async def rate(fn, seconds=1.0):
+    """
+    call coroutine function repeatedly for about seconds
+    :return: calls/sec
+    """
+    n, batch = 0, 1
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            await fn()
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+        batch = min(batch * 2, 10000)
+
+
+async def bench_orm(seconds):
+    users = await User.find_all(limit=1)
+    pk = users[0].id
+    results = dict(
+        select_ops=await rate(lambda: orm.select(User.__select_pk__, [pk], 1), seconds),
+        execute_ops=await rate(lambda: orm.execute("UPDATE `t_users` SET `name`=? WHERE `id`=?", ["x", pk]),
+                               seconds),
+        find_ops=await rate(lambda: User._load(pk), seconds),
+    )
+    row = dict(users[0])
+
+    async def construct():
+        User(**row)
+
+    results["model_construct_ops"] = await rate(construct, seconds)
+    for n in ROW_COUNTS:
+        results["find_all_%s_ops" % n] = await rate(lambda: User.find_all(limit=n), seconds)
+    return results
+
+
+async def bench_binding(seconds):
+    results = {}
+    for name, fn, url, match_info in bench_handler.SHAPES:
+        handler = coroweb.RequestHandler(None, fn)
+        request = bench_handler.BenchRequest(url, match_info)
+        results["%s_ops" % name] = await rate(lambda: handler(request), seconds)
+    return results
+
+
+async def bench_response(seconds):
+    application = web.Application()
+    app.init_jinja2(application, filters={"datetime": app.datetime_filter})
+    users = await User.find_all(limit=20)
+    request = make_mocked_request("GET", "/", app=application)
+
+    async def as_json(request):
+        return dict(users=users)
+
+    async def as_template(request):
+        return {"__template__": "test.html", "users": users}
+
+    results = {}
+    for name, fn in (("json", as_json), ("template", as_template)):
+        handler = await app.response_factory(application, fn)
+        results["%s_ops" % name] = await rate(lambda: handler(request), seconds)
+    return results
+
+
+def bench_http(port, rows, concurrency, duration, backend, path):
+    """
+    load the app served by a subprocess
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), "--serve", str(port), "--rows", str(rows),
+           "--backend", backend, "--db", path]
+    server = subprocess.Popen(cmd, cwd=os.path.join(TESTS, "..", "www"))
+    results = {}
+    try:
+        base = "http://127.0.0.1:%s" % port
+        load_test.wait_ready(base + "/ready")
+        for path in ("/bench/json", "/bench/html", "/"):
+            r = asyncio.run(load_test.load(base + path, concurrency, duration))
+            print("http %-12s %s" % (path, load_test.format_result(r)))
+            results[path] = dict((k, r[k]) for k in ("requests", "errors", "rps", "p50", "p90", "p99"))
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def install_stub(rows):
+    db = fake_aiomysql.FakeDB()
+    db.add_model(User, rows)
+    fake_aiomysql.install(db)
+
+
+async def seed_sqlite(path, rows):
+    """
+    create a fresh sqlite database with rows users
+    """
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    await orm.create_connection_pool(asyncio.get_running_loop(), backend="sqlite", path=path)
+    try:
+        for stmt in User.__ddl_sql__().split(";"):
+            if stmt.strip():
+                await orm.execute(stmt, [])
+        await User.save_many([User(name="user%s" % i, email="user%s@example.com" % i, passwd="x",
+                                   image="about:blank", create_at=i) for i in range(rows)])
+    finally:
+        await orm.close_connection_pool()
+
+
+def serve(port, rows, backend, path):
+    if backend == "stub":
+        install_stub(rows)
+    elif backend == "sqlite":
+        app.configs.db.backend = "sqlite"
+        app.configs.db.path = path
+    app.configs.web.port = port
+    app.configs.web.routes.modules = list(app.configs.web.routes.modules) + ["bench_suite"]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(app.init(loop))
+    loop.run_forever()
+
+
+async def run_local(rows, seconds, backend, path):
+    if backend == "stub":
+        install_stub(rows)
+    c = app.configs.db
+    await orm.create_connection_pool(asyncio.get_running_loop(), backend="sqlite" if backend == "sqlite" else "mysql",
+                                     path=path, user=c.user, password=c.password, db=c.database, host=c.host,
+                                     port=c.port, minsize=1, maxsize=c.maxsize)
+    try:
+        results = {}
+        for name, fn in (("orm", bench_orm), ("binding", bench_binding), ("response", bench_response)):
+            results[name] = await fn(seconds)
+            for k, v in results[name].items():
+                print("%-8s %-24s %12.0f /s" % (name, k, v))
+        return results
+    finally:
+        await orm.close_connection_pool()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=TESTS,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _flatten(d, prefix=""):
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, "%s%s." % (prefix, k))
+        else:
+            yield prefix + k, v
+
+
+def compare(old, new):
+    """
+    print metrics of two result files side by side, latencies are better lower, the rest better higher
+    """
+    old_values = dict(_flatten(old["results"]))
+    print("%-40s %14s %14s %8s" % ("metric (%s -> %s)" % (old.get("commit"), new.get("commit")), "old", "new",
+                                   "change"))
+    for k, v in _flatten(new["results"]):
+        if k in old_values and isinstance(v, (int, float)) and old_values[k]:
+            change = (v - old_values[k]) / old_values[k] * 100
+            print("%-40s %14.2f %14.2f %+7.1f%%" % (k, old_values[k], v, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="orm and coroweb benchmark suite")
+    parser.add_argument("--backend", choices=BACKENDS, default="sqlite",
+                        help="embedded sqlite database, the configured local MySQL, or the fake aiomysql stub")
+    parser.add_argument("--db", default=os.path.join(tempfile.gettempdir(), "awesome-bench.db"),
+                        help="sqlite database file, recreated with --rows users")
+    parser.add_argument("--rows", type=int, default=max(ROW_COUNTS), help="rows of the sqlite or stub user table")
+    parser.add_argument("--seconds", type=float, default=1.0, help="seconds of each micro benchmark")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of each http load, 0 to skip")
+    parser.add_argument("--output", default="bench-%s.json" % (git_commit() or "local"))
+    parser.add_argument("--compare", default=None, help="result file to compare with")
+    parser.add_argument("--serve", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, args.rows, args.backend, args.db)
+    if args.backend == "sqlite":
+        asyncio.run(seed_sqlite(args.db, args.rows))
+    results = asyncio.run(run_local(args.rows, args.seconds, args.backend, args.db))
+    if args.duration > 0:
+        results["http"] = bench_http(args.port, args.rows, args.concurrency, args.duration, args.backend, args.db)
+    data = dict(commit=git_commit(), time=int(time.time()), python=platform.python_version(),
+                platform=platform.platform(), backend=args.backend, results=results)
+    with open(args.output, "w") as f:
+        json.dump(data, f, indent=1)
+    print("results written to %s" % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), data)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
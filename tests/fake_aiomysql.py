@@ -0,0 +1,159 @@
+import asyncio
+import re
+
+import aiomysql
+
+""" in-memory stand-in of aiomysql connections for benchmarks, real aiomysql.Pool queueing with fake connections """
+
+_TABLE = re.compile(r"FROM `?(\w+)`?", re.I)
+_LIMIT = re.compile(r"LIMIT %s(, %s)?\s*$", re.I)
+
+
+class FakeDB(object):
+    """
+    Generated rows of model tables. A select returns LIMIT rows, one row when it has WHERE,
+    all rows of the table otherwise. Each statement waits latency seconds like a network round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.statements = 0
+
+    def add_model(self, model, rows=1000):
+        columns = (model.__primary_key__,) + tuple(model.__fields__)
+        self.tables[model.__table__] = [
+            {c: i if c == "create_at" else "%s-%s" % (c, i) for c in columns} for i in range(rows)]
+
+    def rows(self, sql, args):
+        m = _TABLE.search(sql)
+        table = self.tables.get(m.group(1), []) if m else []
+        if "COUNT(" in sql.upper():
+            return [{"_num_": len(table)}]
+        m = _LIMIT.search(sql)
+        if m:
+            return table[:args[-1]]
+        if " WHERE " in sql.upper():
+            return table[:1]
+        return table
+
+
+class Cursor(object):
+
+    def __init__(self, db, tuples=False):
+        self.db = db
+        self.tuples = tuples
+        self.rowcount = 0
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def execute(self, sql, args=()):
+        self.db.statements += 1
+        if self.db.latency:
+            await asyncio.sleep(self.db.latency)
+        if sql.lstrip()[:6].upper() == "SELECT":
+            rows = self.db.rows(sql, args)
+            self._rows = [tuple(r.values()) for r in rows] if self.tuples else rows
+            self.rowcount = len(rows)
+        else:
+            self._rows = []
+            self.rowcount = 1
+
+    async def executemany(self, sql, args):
+        for a in args:
+            await self.execute(sql, a)
+        self.rowcount = len(args)
+
+    async def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    async def fetchmany(self, size=None):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    async def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    async def close(self):
+        pass
+
+
+class _Reader(object):
+    eof_received = False
+
+    def at_eof(self):
+        return False
+
+    def exception(self):
+        return None
+
+
+class Connection(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.closed = False
+        self.last_usage = 0
+        self._reader = _Reader()
+
+    def cursor(self, cls=None):
+        return Cursor(self.db, tuples=cls in (aiomysql.Cursor, aiomysql.SSCursor))
+
+    def get_transaction_status(self):
+        return False
+
+    async def begin(self):
+        pass
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def ensure_closed(self):
+        self.closed = True
+
+
+class Pool(aiomysql.Pool):
+    """
+    aiomysql.Pool creating fake connections
+    """
+
+    def __init__(self, db, minsize=1, maxsize=10, loop=None):
+        super().__init__(minsize, maxsize, False, -1, loop or asyncio.get_event_loop())
+        self.db = db
+
+    async def _fill_free_pool(self, override_min):
+        while self.size < self.minsize:
+            self._free.append(Connection(self.db))
+            self._cond.notify()
+        if self._free:
+            return
+        if override_min and self.size < self.maxsize:
+            self._free.append(Connection(self.db))
+            self._cond.notify()
+
+
+def install(db):
+    """
+    make orm.create_connection_pool create fake pools of db
+    """
+    import orm
+
+    async def create_pool(loop, **kw):
+        pool = Pool(db, kw.get("minsize", 1), kw.get("maxsize", 10), loop)
+        async with pool._cond:
+            await pool._fill_free_pool(False)
+        return pool
+
+    orm._create_pool = create_pool
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+import aiohttp
+
+""" http load generator, measures throughput and latency percentiles, optionally per server worker count """
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www", "app.py")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+async def load(url, concurrency=50, duration=10.0):
+    """
+    request url from concurrent clients for duration seconds
+    :return: dict of requests, errors, rps and latency percentiles in ms
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(session):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    if resp.status >= 500:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return dict(url=url, concurrency=concurrency, requests=len(latencies), errors=errors,
+                rps=len(latencies) / elapsed,
+                p50=percentile(latencies, 50) * 1000, p90=percentile(latencies, 90) * 1000,
+                p99=percentile(latencies, 99) * 1000)
+
+
+def format_result(r):
+    return "%(requests)8d req %(errors)5d err %(rps)10.1f req/s  p50 %(p50)7.2f ms  p90 %(p90)7.2f ms  " \
+           "p99 %(p99)7.2f ms" % r
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server is not ready: %s" % url)
+
+
+def scale(url, workers_list, concurrency, duration):
+    """
+    start the server with each worker count and load it
+    """
+    for workers in workers_list:
+        server = subprocess.Popen([sys.executable, APP, "--workers", str(workers)], cwd=os.path.dirname(APP))
+        try:
+            wait_ready(url)
+            r = asyncio.run(load(url, concurrency, duration))
+            print("workers %2d: %s" % (workers, format_result(r)))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="http load test")
+    parser.add_argument("--url", default="http://127.0.0.1:9000/")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--workers", default=None, help="comma separated worker counts, e.g. 1,2,4")
+    args = parser.parse_args()
+    if args.workers:
+        scale(args.url, [int(w) for w in args.workers.split(",")], args.concurrency, args.duration)
+    else:
+        print(format_result(asyncio.run(load(args.url, args.concurrency, args.duration))))
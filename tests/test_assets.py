@@ -0,0 +1,48 @@
+import gzip
+import os
+import stat
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import assets
+
+""" static asset builds: existing files are verified and rebuilt when they don't match """
+
+CSS = b"body { color: red; }\n" * 100
+
+
+def build(tmp_path):
+    source = tmp_path / "static"
+    (source / "css").mkdir(parents=True, exist_ok=True)
+    (source / "css" / "app.css").write_bytes(CSS)
+    return assets.build(str(source), str(tmp_path / "build"), use_brotli=False)["css/app.css"]
+
+
+def test_build_fingerprints_and_compresses(tmp_path):
+    asset = build(tmp_path)
+    assert assets.static_url("css/app.css") == "/static/" + asset.url_path
+    assert open(asset.file, "rb").read() == CSS
+    assert gzip.decompress(open(asset.file + ".gz", "rb").read()) == CSS
+    assert asset.encodings == ["gzip"]
+
+
+def test_build_rewrites_tampered_files(tmp_path):
+    asset = build(tmp_path)
+    with open(asset.file, "wb") as f:
+        f.write(b"tampered")
+    with open(asset.file + ".gz", "wb") as f:
+        f.write(gzip.compress(b"tampered"))
+    with open(asset.file + ".br", "wb") as f:
+        f.write(b"tampered")
+    asset = build(tmp_path)
+    assert open(asset.file, "rb").read() == CSS
+    assert gzip.decompress(open(asset.file + ".gz", "rb").read()) == CSS
+    # brotli is off, FileResponse must not find a sibling
+    assert not os.path.exists(asset.file + ".br")
+
+
+def test_default_build_dir_is_private():
+    path = assets._private_dir()
+    st = os.stat(path)
+    assert st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == stat.S_IRWXU
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+from cache import LRUCache
+
+""" read-through cache loads """
+
+
+def test_concurrent_misses_load_once():
+    cache = LRUCache(ttl=60, maxsize=10)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "value"
+
+    async def main():
+        return await asyncio.gather(*[cache.get_or_load("k", load) for _ in range(5)])
+
+    assert asyncio.run(main()) == ["value"] * 5
+    assert len(calls) == 1
+
+
+def test_cancelled_loader_does_not_cancel_waiters():
+    cache = LRUCache(ttl=60, maxsize=10)
+    calls = []
+
+    async def load():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def main():
+        first = asyncio.ensure_future(cache.get_or_load("k", load))
+        await asyncio.sleep(0)
+        waiters = [asyncio.ensure_future(cache.get_or_load("k", load)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.gather(*waiters)
+
+    # one waiter loads again, the others share its load
+    assert asyncio.run(main()) == [2, 2, 2]
+    assert len(calls) == 2
+
+
+def test_cancelled_waiter_leaves_load_running():
+    cache = LRUCache(ttl=60, maxsize=10)
+
+    async def load():
+        await asyncio.sleep(0.02)
+        return "value"
+
+    async def main():
+        first = asyncio.ensure_future(cache.get_or_load("k", load))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_load("k", load))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await first
+
+    assert asyncio.run(main()) == "value"
+    assert cache.get("k") == "value"
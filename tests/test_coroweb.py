@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+import warnings
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import coroweb
+from coroweb import url_route
+
+""" argument binding and request body limits of routes, served by an aiohttp test server """
+
+
+@url_route("/upload", method="POST", max_body=5000)
+async def upload(*, name=None, file=None):
+    return web.Response(text=str(len(name) if name is not None else len(file.file.read())))
+
+
+async def post(size, kind, client_max_size=1000):
+    app = web.Application(client_max_size=client_max_size)
+    app.router.add_route("POST", "/upload", coroweb.RequestHandler(app, upload))
+    async with TestClient(TestServer(app)) as client:
+        if kind == "json":
+            r = await client.post("/upload", json={"name": "x" * size})
+        elif kind == "form":
+            r = await client.post("/upload", data={"name": "x" * size})
+        else:
+            form = aiohttp.FormData()
+            form.add_field("file", b"x" * size, filename="f.bin")
+            r = await client.post("/upload", data=form)
+        return r.status, await r.text()
+
+
+@pytest.mark.parametrize("kind", ["json", "form", "multipart"])
+def test_route_max_body_above_client_max_size(kind):
+    assert asyncio.run(post(3000, kind)) == (200, "3000")
+    status, text = asyncio.run(post(6000, kind))
+    assert status == 413 and "5000" in text
+
+
+@url_route("/items/{id}")
+async def item(id: int, *, tags: list = None, draft: bool = False, limit: int = 10):
+    return web.json_response(dict(id=id, tags=tags, draft=draft, limit=limit))
+
+
+@url_route("/items", method="POST")
+async def create(*, name, count: int = 1):
+    return web.json_response(dict(name=name, count=count))
+
+
+async def call(method, path, **kw):
+    app = web.Application()
+    app.router.add_route("GET", "/items/{id}", coroweb.RequestHandler(app, item))
+    app.router.add_route("POST", "/items", coroweb.RequestHandler(app, create))
+    async with TestClient(TestServer(app)) as client:
+        r = await client.request(method, path, **kw)
+        return r.status, await (r.json() if r.status == 200 else r.text())
+
+
+def test_arguments_coerced_by_annotation():
+    status, data = asyncio.run(call("GET", "/items/7?tags=a&tags=b&draft=yes&limit=3"))
+    assert (status, data) == (200, dict(id=7, tags=["a", "b"], draft=True, limit=3))
+    status, data = asyncio.run(call("GET", "/items/7?tags=a"))
+    assert (status, data) == (200, dict(id=7, tags=["a"], draft=False, limit=10))
+    status, data = asyncio.run(call("POST", "/items", json={"name": "x", "count": "2", "other": 1}))
+    assert (status, data) == (200, dict(name="x", count=2))
+
+
+@pytest.mark.parametrize("method, path, kw, message", [
+    ("GET", "/items/x", {}, "Invalid argument id"),
+    ("GET", "/items/7?limit=many", {}, "Invalid argument limit"),
+    ("POST", "/items", dict(json={"count": 2}), "Missing required argument: name"),
+    ("POST", "/items", dict(data="{", headers={"Content-Type": "application/json"}), "Invalid JSON body"),
+    ("POST", "/items", dict(json=[1]), "JSON body must be object"),
+    ("POST", "/items", dict(data="x", headers={"Content-Type": "text/plain"}), "Unsupported Content-Type"),
+])
+def test_invalid_arguments_are_bad_requests(method, path, kw, message):
+    status, text = asyncio.run(call(method, path, **kw))
+    assert status == 400 and message in text
+
+
+async def resolve(static, requests):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        app = web.Application(router=coroweb.Router())
+
+    def handler(text):
+        async def handle(request):
+            return web.Response(text=text % request.match_info)
+        return handle
+
+    for i in range(static):
+        app.router.add_route("GET", "/page/%s" % i, handler("page %s" % i))
+    app.router.add_route("GET", "/items/{id}", handler("item %(id)s"))
+    app.router.add_route("POST", "/form", handler("form"))
+    async with TestClient(TestServer(app)) as client:
+        fast = bool(app.router._static)
+        results = []
+        for method, path in requests:
+            r = await client.request(method, path)
+            results.append((r.status, await r.text() if r.status == 200 else None))
+        return fast, results
+
+
+@pytest.mark.parametrize("static", [2, coroweb.Router.FAST_PATH_MIN])
+def test_router_resolve(static):
+    fast, results = asyncio.run(resolve(static, [
+        ("GET", "/page/1"), ("GET", "/items/7"), ("POST", "/form"), ("GET", "/form"), ("GET", "/nope"),
+        ("POST", "/page/1")]))
+    assert fast == (static >= coroweb.Router.FAST_PATH_MIN)
+    assert results == [(200, "page 1"), (200, "item 7"), (200, "form"), (405, None), (404, None), (405, None)]
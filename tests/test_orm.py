@@ -1,24 +1,308 @@
-import logging
 import asyncio
-from www import orm
-from www.models import User
-
-
-async def test(lp):
-    await orm.create_connection_pool(lp, user="pabb", password="pabb", db="awesome", host="192.168.3.250")
-    # u = User(name="vic", email="test@126.com", passwd="123456", image="about:blank")
-    # print(User.__select__)
-    sql = User.__select__
-    print(sql)
-    # sql = User.__ddl_sql__()
-    # print(sql)
-    # await u.save()
-    # ret = await User.find_all()
-    # print(len(ret), ret)
-    rets = await orm.select(sql, [])
-    print(rets)
-
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.DEBUG)
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(test(loop))
+import json
+import os
+import sys
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import app
+import cache
+import encoder
+import orm
+from models import User, business_id
+
+""" orm behaviour on an embedded sqlite database, one fresh database file per test """
+
+
+class Post(orm.Model):
+    """
+    model with find cache
+    """
+    __table__ = "t_test_posts"
+    __cache__ = dict(ttl=60, maxsize=100)
+
+    id = orm.StringField(primary_key=True, default=business_id)
+    title = orm.StringField(ddl="varchar(50)")
+    create_at = orm.IntegerField(index=True)
+
+
+MODELS = (User, Post)
+
+
+class Route(object):
+    """
+    cached route of the response cache
+    """
+    cache = 60
+    cache_models = (User,)
+
+
+@pytest.fixture
+def run(tmp_path):
+    """
+    run coroutines on an event loop with orm pools of a fresh sqlite database
+    """
+    loop = asyncio.new_event_loop()
+
+    async def setup():
+        await orm.create_connection_pool(loop, backend="sqlite", path=str(tmp_path / "test.db"), maxsize=4)
+        for model in MODELS:
+            model.__count_cache__.clear()
+            if model.__find_cache__ is not None:
+                model.__find_cache__.clear()
+            for stmt in model.__ddl_sql__().split(";"):
+                if stmt.strip():
+                    await orm.execute(stmt, [])
+
+    loop.run_until_complete(setup())
+    yield loop.run_until_complete
+    loop.run_until_complete(orm.close_connection_pool())
+    loop.close()
+
+
+def user(name, create_at=0):
+    return User(name=name, email="%s@example.com" % name, passwd="x", image="about:blank", create_at=create_at)
+
+
+async def names():
+    return sorted(u.name for u in await User.find_all())
+
+
+def test_save_many_modify_many_remove_many(run):
+    users = [user("u%s" % i, i) for i in range(5)]
+    assert run(User.save_many(users, chunk_size=2)) == [2, 2, 1]
+    assert run(names()) == ["u0", "u1", "u2", "u3", "u4"]
+    for u in users:
+        u.name = u.name.upper()
+    assert run(User.modify_many(users, chunk_size=3)) == [3, 2]
+    assert run(names()) == ["U0", "U1", "U2", "U3", "U4"]
+    assert run(User.remove_many(users[:3], chunk_size=2)) == [2, 1]
+    assert run(names()) == ["U3", "U4"]
+    assert run(User.save_many([])) == []
+
+
+def test_bulk_write_rolls_back_as_a_whole(run):
+    u = user("dup")
+    run(u.save())
+    with pytest.raises(Exception):
+        run(User.save_many([user("a"), user("b"), u], chunk_size=2))
+    assert run(names()) == ["dup"]
+
+
+def test_transaction_commit_and_rollback(run):
+    async def commit():
+        async with orm.transaction():
+            await user("a").save()
+            await user("b").save()
+            # reads in the transaction see its writes
+            return await names()
+
+    async def rollback():
+        async with orm.transaction():
+            await user("c").save()
+            raise ValueError()
+
+    assert run(commit()) == ["a", "b"]
+    with pytest.raises(ValueError):
+        run(rollback())
+    assert run(names()) == ["a", "b"]
+    assert orm.current_transaction() is None
+
+
+def test_savepoint_rollback(run):
+    async def nested():
+        async with orm.transaction() as tx:
+            await user("outer").save()
+            try:
+                async with orm.transaction() as inner:
+                    assert inner is tx
+                    await user("inner").save()
+                    raise ValueError()
+            except ValueError:
+                pass
+            async with orm.transaction():
+                await user("kept").save()
+
+    run(nested())
+    assert run(names()) == ["kept", "outer"]
+
+
+def test_find_cache_invalidated_on_write(run):
+    p = Post(title="old", create_at=1)
+    run(p.save())
+    assert run(Post.find(p.id)).title == "old"
+    p.title = "new"
+    run(p.modify())
+    assert run(Post.find(p.id)).title == "new"
+
+    async def rollback():
+        async with orm.transaction():
+            p.title = "rolled back"
+            await p.modify()
+            raise ValueError()
+
+    with pytest.raises(ValueError):
+        run(rollback())
+    assert run(Post.find(p.id)).title == "new"
+    run(p.remove())
+    assert run(Post.find(p.id)) is None
+
+
+def test_response_cache_invalidated_on_write(run):
+    route = Route()
+    responses = app._response_cache(route)
+    responses.set("/", "rendered")
+    run(user("a").save())
+    assert responses.get("/") is None
+
+    async def write(fail):
+        async with orm.transaction():
+            await user("b" if fail else "c").save()
+            # rendered before commit, still cached
+            assert responses.get("/") == "rendered"
+            if fail:
+                raise ValueError()
+
+    responses.set("/", "rendered")
+    with pytest.raises(ValueError):
+        run(write(True))
+    assert responses.get("/") == "rendered"
+    run(write(False))
+    assert responses.get("/") is None
+
+
+@pytest.mark.parametrize("header, status", [
+    ('"abc"', 304),
+    ('W/"abc"', 304),
+    ('"x", W/"abc"', 304),
+    ("*", 304),
+    ('"x", "y"', 200),
+    (None, 200),
+])
+def test_cached_response_if_none_match(header, status):
+    request = make_mocked_request("GET", "/", headers={"If-None-Match": header} if header else {})
+    resp = app._cached_response(request, (200, "text/html", b"body", '"abc"'))
+    assert resp.status == status and resp.headers["ETag"] == '"abc"'
+
+
+def test_query_compile(run):
+    q = User.query().filter(name="a", create_at__gte=1).order_by("-create_at").limit(10, 20)
+    sql, args = q._compile("select")
+    assert sql == "%s WHERE `name`=? AND `create_at`>=? ORDER BY `create_at` DESC LIMIT ?, ?" % User.__select__
+    assert args == ["a", 1, 20, 10]
+    # statements are cached by shape, values are arguments
+    assert User.query().filter(name="b", create_at__gte=2).order_by("-create_at").limit(1, 2)._compile("select")[0] \
+        is sql
+    sql, args = User.query().filter(id__in=["x", "y"]).where("`admin`=?", True)._compile("count")
+    assert sql == "SELECT COUNT(1) _num_ FROM `t_users` WHERE `id` IN (?, ?) AND (`admin`=?)"
+    assert args == ["x", "y", True]
+    with pytest.raises(ValueError):
+        User.query().filter(nope=1)
+
+
+def test_query_results(run):
+    run(User.save_many([user("u%s" % i, i) for i in range(5)]))
+    q = User.query().filter(create_at__gte=1).order_by("-create_at")
+    assert [u.name for u in run(q.limit(2).all())] == ["u4", "u3"]
+    assert run(q.count()) == 4
+    assert run(q.exists())
+    assert run(User.query().filter(name="nope").first()) is None
+
+    async def iterate(query):
+        return [obj async for obj in query]
+
+    objs = run(iterate(q))
+    assert [u.name for u in objs] == ["u4", "u3", "u2", "u1"]
+    assert all(isinstance(u, User) for u in objs)
+
+
+def test_query_projection_iterate(run):
+    run(User.save_many([user("u%s" % i, i) for i in range(3)]))
+    q = User.query().only("name", "create_at").order_by("create_at")
+
+    async def iterate():
+        return [row async for row in q]
+
+    async def iterate_in_transaction():
+        async with orm.transaction():
+            return await iterate()
+
+    async def stream():
+        return [encoder.dumps(row) async for row in encoder.JSONStream(q)._iter()]
+
+    expected = [("u0", 0), ("u1", 1), ("u2", 2)]
+    assert [(r.name, r.create_at) for r in run(iterate())] == expected
+    assert [(r.name, r.create_at) for r in run(iterate_in_transaction())] == expected
+    assert run(q.all()) == run(iterate())
+    assert [json.loads(s) for s in run(stream())] == [dict(name=n, create_at=c) for n, c in expected]
+
+
+def test_find_many_ordering(run):
+    users = [user("u%s" % i) for i in range(3)]
+    run(User.save_many(users))
+    pks = [users[2].id, "missing", users[0].id, users[2].id, None]
+    found = run(User.find_many(pks, chunk_size=1))
+    assert [u and u.name for u in found] == ["u2", None, "u0", "u2", None]
+
+
+def test_find_cache_returns_copies(run):
+    p = Post(title="cached", create_at=1)
+    run(p.save())
+    found = run(Post.find(p.id))
+    found.title = "changed without save"
+    assert run(Post.find(p.id)).title == "cached"
+    many = run(Post.find_many([p.id]))
+    many[0].title = "changed without save"
+    assert run(Post.find_many([p.id]))[0].title == "cached"
+    assert run(Post.find(p.id)).title == "cached"
+
+
+def test_find_many_uses_find_cache(run):
+    p = Post(title="cached", create_at=1)
+    run(p.save())
+    run(Post.find(p.id))
+    hits = Post.__find_cache__.hits
+    assert [o.title for o in run(Post.find_many([p.id]))] == ["cached"]
+    assert Post.__find_cache__.hits == hits + 1
+
+
+def test_count_cached_adjusted_on_write(run):
+    run(User.save_many([user("a"), user("b")]))
+    assert run(User.count(mode="cached")) == orm.Count(2, True)
+    assert run(User.count(mode="cached")) == orm.Count(2, False)
+    run(user("c").save())
+    assert run(User.count(mode="cached")) == orm.Count(3, False)
+    assert run(User.count(mode="exact")) == orm.Count(3, True)
+
+
+def test_count_cache_stats(run):
+    counts = User.__count_cache__
+    hits, misses = counts.hits, counts.misses
+    assert run(User.count("`admin`=?", [False], mode="cached")) == orm.Count(0, True)
+    assert run(User.count("`admin`=?", [False], mode="cached")) == orm.Count(0, False)
+    assert (counts.hits - hits, counts.misses - misses) == (1, 1)
+
+
+def test_caches_registered():
+    assert "t_test_posts" in cache.stats()
+
+
+def test_loader_batches_and_survives_clear(run):
+    users = [user("u%s" % i) for i in range(3)]
+    run(User.save_many(users))
+
+    async def load():
+        loader = User.loader()
+        first = loader.load(users[0].id)
+        rest = loader.load_many([users[1].id, "missing"])
+        await asyncio.sleep(0)
+        # the batch is running, its futures are resolved anyway
+        loader.clear()
+        again = loader.load(users[0].id)
+        return (await asyncio.wait_for(first, 1)).name, [u and u.name for u in await rest], \
+            (await asyncio.wait_for(again, 1)).name
+
+    assert run(load()) == ("u0", ["u1", None], "u0")
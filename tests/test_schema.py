@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import orm
+import schema
+from models import business_id
+
+""" declared model indexes, their DDL and the schema diff against a live sqlite database """
+
+
+class Event(orm.Model):
+    """
+    model with field indexes, a renamed column and __indexes__ entries
+    """
+    __table__ = "t_test_events"
+    # "user_id" repeats the field index and is dropped
+    __indexes__ = [("user_id", "kind"), orm.Index("kind", "create_at", name="ix_kind_time"), "user_id"]
+
+    id = orm.StringField(primary_key=True, default=business_id)
+    user_id = orm.StringField(index=True)
+    kind = orm.StringField(name="event_kind")
+    code = orm.StringField(unique=True)
+    create_at = orm.IntegerField()
+
+
+DECLARED = [
+    ("idx_t_test_events_user_id", ("user_id",), False),
+    ("uk_t_test_events_code", ("code",), True),
+    ("idx_t_test_events_user_id_event_kind", ("user_id", "event_kind"), False),
+    ("ix_kind_time", ("event_kind", "create_at"), False),
+]
+# the single column index is kept as declared, schema_diff only reports it
+REDUNDANT = "-- index idx_t_test_events_user_id of t_test_events is a prefix of idx_t_test_events_user_id_event_kind"
+
+
+@pytest.fixture
+def run(tmp_path):
+    """
+    run coroutines on an event loop with orm pools of a fresh sqlite database
+    """
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(orm.create_connection_pool(loop, backend="sqlite", path=str(tmp_path / "test.db"),
+                                                       maxsize=2))
+    yield loop.run_until_complete
+    loop.run_until_complete(orm.close_connection_pool())
+    loop.close()
+
+
+async def execute(sql):
+    for stmt in sql.split(";"):
+        if stmt.strip():
+            await orm.execute(stmt, [])
+
+
+def test_model_indexes():
+    assert [(i.name, i.columns, i.unique) for i in Event.__indexes__] == DECLARED
+    mappings = dict(a=orm.StringField(name="a" * 40), b=orm.StringField(name="b" * 40))
+    index, = orm._model_indexes("t_long", mappings, [("a", "b")])
+    assert len(index.name) == orm.INDEX_NAME_SIZE and index.name.startswith("idx_t_long_aaa")
+    with pytest.raises(ValueError):
+        orm._model_indexes("t_test_events", Event.__mappings__, [("nope",)])
+
+
+def test_gen_sql_creates_indexes():
+    ddl = Event.__ddl_sql__()
+    assert [line for line in ddl.splitlines() if line.startswith("CREATE ") and "INDEX" in line] == [
+        "CREATE INDEX `idx_t_test_events_user_id` ON `t_test_events` (`user_id`);",
+        "CREATE UNIQUE INDEX `uk_t_test_events_code` ON `t_test_events` (`code`);",
+        "CREATE INDEX `idx_t_test_events_user_id_event_kind` ON `t_test_events` (`user_id`, `event_kind`);",
+        "CREATE INDEX `ix_kind_time` ON `t_test_events` (`event_kind`, `create_at`);",
+    ]
+    assert "DROP TABLE IF EXISTS `t_test_events`;" in ddl
+
+
+def test_live_indexes_match_declared(run):
+    run(execute(Event.__ddl_sql__()))
+    live = run(schema.live_indexes("t_test_events"))
+    assert sorted((i.name, i.columns, i.unique) for i in live) == sorted(DECLARED)
+    assert schema.diff(Event.__indexes__, live) == ([], [])
+    assert run(schema.schema_diff([Event])) == [REDUNDANT]
+
+
+def test_migration_of_changed_indexes(run):
+    run(execute(Event.__ddl_sql__()))
+    run(execute("DROP INDEX `ix_kind_time`; CREATE INDEX `ix_extra` ON `t_test_events` (`create_at`)"))
+    add, extra = schema.diff(Event.__indexes__, run(schema.live_indexes("t_test_events")))
+    assert [i.name for i in add] == ["ix_kind_time"] and [i.name for i in extra] == ["ix_extra"]
+    assert schema.migration("t_test_events", add, extra) == [
+        "-- undeclared index of t_test_events: ix_extra (`create_at`)",
+        "CREATE INDEX `ix_kind_time` ON `t_test_events` (`event_kind`, `create_at`);",
+    ]
+    sql = schema.migration("t_test_events", add, extra, drop=True)
+    assert sql == ["DROP INDEX `ix_extra`;",
+                   "CREATE INDEX `ix_kind_time` ON `t_test_events` (`event_kind`, `create_at`);"]
+    for stmt in sql:
+        run(execute(stmt))
+    assert run(schema.schema_diff([Event], drop=True)) == [REDUNDANT]
+
+
+def test_schema_diff_of_missing_table(run):
+    sql = run(schema.schema_diff([Event]))
+    assert len(sql) == 2 and sql[0] == REDUNDANT and sql[1].startswith("CREATE TABLE `t_test_events`")
+    assert "DROP TABLE" not in sql[1] and sql[1].count("CREATE INDEX") == 3
+    run(execute(sql[1]))
+    assert run(schema.schema_diff([Event])) == [REDUNDANT]
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "www"))
+
+import orm
+import warmup
+
+""" readiness after warm-up phases """
+
+
+async def ok():
+    return True
+
+
+async def fail():
+    raise ConnectionError("Can't connect to MySQL server")
+
+
+async def run(phases, optional=()):
+    await warmup.start(phases, optional=optional)
+    return warmup.ready, dict(warmup.failed)
+
+
+def test_ready_when_phases_pass():
+    assert asyncio.run(run(dict(pool_prefill=ok(), templates=ok()))) == (True, {})
+
+
+def test_optional_phase_failure_is_best_effort():
+    ready, failed = asyncio.run(run(dict(pool_prefill=ok(), templates=fail()), optional=("templates",)))
+    assert ready and list(failed) == ["templates"]
+
+
+def test_required_phase_failure_keeps_not_ready():
+    ready, failed = asyncio.run(run(dict(pool_prefill=fail(), templates=ok()), optional=("templates",)))
+    assert not ready and "MySQL" in failed["pool_prefill"]
+    # a new warm-up starts clean
+    assert asyncio.run(run(dict(pool_prefill=ok()))) == (True, {})
+
+
+class FailingPool(object):
+    maxsize = 2
+    size = 0
+
+    async def acquire(self):
+        raise OSError("connection refused")
+
+
+def test_prefill_failure_raises():
+    orm._register_pool("broken", FailingPool())
+    try:
+        ready, failed = asyncio.run(run(dict(pool_prefill=orm.prefill_pools(2))))
+    finally:
+        orm._pools.clear()
+        orm._pool_names.clear()
+    assert not ready and "broken" in failed["pool_prefill"]
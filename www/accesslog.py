@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import logging.handlers
+import queue
+import random
+
+__author__ = "Vic Yue"
+
+""" structured, sampled access log, log records are written by a listener thread off the event loop """
+
+logger = logging.getLogger("access")
+logger.propagate = False
+
+# options of access log
+sample_rate = 1.0
+slow_ms = 500.0
+_listener = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving record formatting to the listener thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format access records as one json object per line
+    """
+
+    def format(self, record):
+        data = getattr(record, "access", None)
+        if data is None:
+            data = dict(level=record.levelname, logger=record.name, message=record.getMessage())
+        return json.dumps(dict(data, time=round(record.created, 3)), ensure_ascii=False, separators=(",", ":"))
+
+
+def setup(level=logging.INFO, rate=1.0, slow=500.0, filename=None):
+    """
+    route access log and root log handlers through a queue listener thread
+    :param level: access log level, records are dropped before formatting below it
+    :param rate: sample rate of normal requests, errors and slow requests are always logged
+    :param slow: latency in ms over which a request is slow
+    :param filename: access log file, default stderr
+    """
+    global sample_rate, slow_ms, _listener
+    sample_rate = rate
+    slow_ms = slow
+    if _listener is not None:
+        _listener.stop()
+    q = queue.SimpleQueue()
+    access_handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    access_handler.setFormatter(JSONFormatter())
+    access_handler.addFilter(lambda r: r.name == "access")
+    root = logging.getLogger()
+    root_handlers = [h for h in root.handlers if not isinstance(h, _QueueHandler)]
+    for h in root_handlers:
+        root.removeHandler(h)
+        h.addFilter(lambda r: r.name != "access")
+    root.addHandler(_QueueHandler(q))
+    logger.handlers = [_QueueHandler(q)]
+    logger.setLevel(level)
+    _listener = logging.handlers.QueueListener(q, access_handler, *root_handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop():
+    """
+    flush queued records and stop listener thread
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def log(request, status, elapsed, db=None):
+    """
+    log one request, checks level and sampling before building the record
+    :param request: web.Request
+    :param status: response status
+    :param elapsed: request latency seconds
+    :param db: orm.DBTime of request
+    """
+    latency = elapsed * 1000
+    if status >= 500:
+        level = logging.ERROR
+    elif latency >= slow_ms:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return
+    if not logger.isEnabledFor(level):
+        return
+    data = dict(method=request.method, path=request.path, status=status, latency_ms=round(latency, 3))
+    if db is not None:
+        data.update(db_ms=round(db.seconds * 1000, 3), db_queries=db.queries)
+    logger.log(level, "access", extra=dict(access=data))
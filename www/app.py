@@ -2,18 +2,30 @@
 # -*- coding: utf-8 -*-
 
 
+import argparse
 import asyncio
-import json
+import hashlib
 import logging
+import multiprocessing
 import os
+import signal
+import tempfile
 import time
+import warnings
 from datetime import datetime
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 import orm
+import accesslog
+import assets
+import tracing
+import warmup
 import coroweb
+import encoder
+import metrics
+from cache import LRUCache
 from config import configs
 
 __author__ = "Vic Yue"
@@ -21,21 +33,35 @@ __author__ = "Vic Yue"
 logging.basicConfig(level=logging.INFO)
 
 
-def init_jinja2(app, *, path=None, filters=None):
+TEMPLATE_RENDER_SECONDS = metrics.Histogram("template_render_seconds", "Template render time.", ("template",))
+
+
+def init_jinja2(app, *, path=None, filters=None, globals=None, production=False, bytecode_cache=None):
     """
     Init server jinja2 module
     :param app: web.Application object.
     :param path: jinja2 template path.
     :param filters: jinja2 convert filters.
+    :param globals: jinja2 global functions, e.g. static_url.
+    :param production: no auto reload, bytecode cache and async rendering, templates are compiled by warm-up.
+    :param bytecode_cache: bytecode cache directory of production mode, default a per-user temp directory.
     :return:
     """
     logging.info("Init jinja2 ...")
-    options = dict(auto_reload=True,
+    options = dict(auto_reload=not production,
                    block_start_string="{%",
                    block_end_string="%}",
                    variable_start_string="{{",
                    variable_end_string="}}",
                    autoescape=True)
+    if production:
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            cache = FileSystemBytecodeCache(bytecode_cache)
+        else:
+            # jinja2 default, a per-user directory it checks for ownership and mode
+            cache = FileSystemBytecodeCache()
+        options.update(bytecode_cache=cache, enable_async=True, cache_size=-1)
     if not path:
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
     logging.info("set jinja2 template path: %s" % path)
@@ -43,38 +69,173 @@ def init_jinja2(app, *, path=None, filters=None):
     if filters is not None and isinstance(filters, dict):
         for name, filter_func in filters.items():
             env.filters[name] = filter_func
+    if globals is not None:
+        env.globals.update(globals)
     app["__templating__"] = env
 
 
+def precompile_templates(env):
+    """
+    compile all templates into environment cache
+    :param env: jinja2 Environment
+    :return: compiled template names
+    """
+    start = time.monotonic()
+    names = [name for name in env.list_templates() if name.endswith((".html", ".htm", ".xml", ".txt"))]
+    for name in names:
+        env.get_template(name)
+    logging.info("precompiled %s templates in %.3fs" % (len(names), time.monotonic() - start))
+    return names
+
+
+async def render_template(request, env, template, context):
+    """
+    render template to response, streamed as chunked response when context has __stream__ set
+    :param request: web.Request
+    :param env: jinja2 Environment
+    :param template: template name
+    :param context: template context
+    :return: web.Response or web.StreamResponse
+    """
+    start = time.monotonic()
+    tpl = env.get_template(template)
+    if context.get("__stream__", False):
+        resp = web.StreamResponse()
+        resp.content_type = "text/html"
+        resp.charset = "utf-8"
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        if env.is_async:
+            async for chunk in tpl.generate_async(**context):
+                await resp.write(chunk.encode())
+        else:
+            for chunk in tpl.generate(**context):
+                await resp.write(chunk.encode())
+        await resp.write_eof()
+    else:
+        body = await tpl.render_async(**context) if env.is_async else tpl.render(**context)
+        resp = web.Response(body=body.encode())
+        resp.content_type = "text/html;charset=utf-8"
+    TEMPLATE_RENDER_SECONDS.observe(time.monotonic() - start, template)
+    tracing.record("render", time.monotonic() - start, template)
+    return resp
+
+
 async def logger_factory(app, handler):
     async def logger(request):
         assert isinstance(request, web.Request)
-        logging.info("Request: %s: %s" % (request.method, request.path))
-        return await handler(request)
+        start = time.monotonic()
+        db = orm.track_db_time()
+        status = 500
+        try:
+            resp = await handler(request)
+            status = resp.status
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            accesslog.log(request, status, time.monotonic() - start, db)
 
     return logger
 
 
-async def data_factory(app, handler):
-    async def data_parse(request):
-        assert isinstance(request, web.Request)
-        if request.method == "POST":
-            content = request.content_type
-            if content.startswith("application/json"):
-                request.__data__ = await request.json()
-                logging.info("request with json: %s" % str(request.__data__))
-            elif content.startswith("application/x-www-form-urlencoded"):
-                request.__data__ = await request.post()
-                logging.info("request with post: %s" % str(request.__data__))
-        return await handler(request)
+async def trace_factory(app, handler):
+    async def trace(request):
+        resource = request.match_info.route.resource
+        # unmatched requests have no route, they are not profiled
+        route = resource.canonical if resource is not None else None
+        t = tracing.start(request.method, request.path, route)
+        status = 500
+        try:
+            if route is not None and tracing.profiler is not None and tracing.profiler.sample():
+                resp = await tracing.profiler.run(route, handler, request)
+            else:
+                resp = await handler(request)
+            status = resp.status
+            # streamed responses have sent their headers already
+            if not resp.prepared:
+                resp.headers["Server-Timing"] = t.server_timing()
+            return resp
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            tracing.finish(t, status)
+
+    return trace
+
+
+# max cached responses of each route
+RESPONSE_CACHE_SIZE = 1000
+# route handler -> response cache, table name -> route handlers cached with the model
+_response_caches = {}
+_model_routes = {}
 
-    return data_parse
+
+def _response_cache(route):
+    cache = _response_caches.get(route)
+    if cache is None:
+        cache = _response_caches[route] = LRUCache(ttl=route.cache, maxsize=RESPONSE_CACHE_SIZE)
+        for model in route.cache_models:
+            _model_routes.setdefault(getattr(model, "__table__", model), []).append(route)
+    return cache
+
+
+def invalidate_responses(route=None):
+    """
+    drop cached responses
+    :param route: RequestHandler of route, None for all routes
+    """
+    for r, cache in _response_caches.items():
+        if route is None or r is route:
+            cache.clear()
+
+
+@orm.on_write
+def _invalidate_model_responses(model):
+    # caches are per process: with --workers N only the worker that wrote is invalidated,
+    # the others serve their cached responses until the route cache ttl expires
+    for route in _model_routes.get(model.__table__, ()):
+        _response_caches[route].clear()
+
+
+def _cached_response(request, entry):
+    status, content_type, body, etag = entry
+    # weak comparison, If-None-Match is * or a list of tags that may have a W/ prefix
+    if any(tag.value == "*" or '"%s"' % tag.value == etag for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers={"ETag": etag})
+    return web.Response(status=status, body=body, headers={"Content-Type": content_type, "ETag": etag})
+
+
+async def cache_factory(app, handler):
+    async def cache(request):
+        route = request.match_info.handler
+        if request.method not in ("GET", "HEAD") or getattr(route, "cache", None) is None:
+            return await handler(request)
+        key = (request.path, request.query_string) + tuple(request.headers.get(h) for h in route.cache_vary)
+        rendered = {}
+
+        async def render():
+            resp = await handler(request)
+            rendered["resp"] = resp
+            if type(resp) is not web.Response or resp.status != 200 or not isinstance(resp.body, bytes):
+                return None
+            body = resp.body
+            return resp.status, resp.headers.get("Content-Type"), body, '"%s"' % hashlib.sha1(body).hexdigest()
+
+        entry = await _response_cache(route).get_or_load(key, render)
+        if entry is None:
+            # not cacheable, waiters of the same render call handler by themselves
+            return rendered["resp"] if "resp" in rendered else await handler(request)
+        return _cached_response(request, entry)
+
+    return cache
 
 
 async def response_factory(app, handler):
     async def response(request):
         assert isinstance(request, web.Request)
-        logging.info("Response handler...")
         r = await handler(request)
         if isinstance(r, web.StreamResponse):
             return r
@@ -89,19 +250,17 @@ async def response_factory(app, handler):
             resp = web.Response(body=r.encode())
             resp.content_type = "text/html;charset=utf-8"
             return resp
+        elif isinstance(r, encoder.JSONStream):
+            return await r.write(request)
         elif isinstance(r, dict):
             template = r.get("__template__", None)
             if template is None:
-                body = json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__)
-                resp = web.Response(body=body.encode())
-                resp.content_type = "application/json;charset=utf-8"
-                return resp
+                return encoder.json_response(r)
             jinja_env = app["__templating__"]
             assert isinstance(jinja_env, Environment)
-            body = jinja_env.get_template(template).render(**r)
-            resp = web.Response(body=body.encode())
-            resp.content_type = "text/html;charset=utf-8"
-            return resp
+            return await render_template(request, jinja_env, template, r)
+        elif isinstance(r, list):
+            return encoder.json_response(r)
         elif isinstance(r, int) and 100 <= r < 600:
             return web.Response(status=r)
         elif isinstance(r, tuple) and len(r) == 2:
@@ -131,30 +290,232 @@ def datetime_filter(t):
         return "%s年%s月%s日" % (dt.year, dt.month, dt.day)
 
 
-async def init(loop):
-    await orm.create_connection_pool(loop, user=configs.db.user, password=configs.db.password, db=configs.db.database,
-                                     host=configs.db.host)
-    app = web.Application(loop=loop, middlewares=(
-        logger_factory, data_factory, response_factory
-    ))
-    init_jinja2(app, filters={"datetime": datetime_filter})
-    coroweb.add_routes(app, "handlers")
-    coroweb.add_static(app)
+def load_routes():
+    """
+    route registry from manifest when lazy routes are enabled and the manifest exists, scanned modules otherwise
+    :return: coroweb.RouteRegistry
+    """
+    routes = configs.web.routes
+    if routes.lazy and routes.manifest and os.path.exists(routes.manifest):
+        return coroweb.RouteRegistry.load_manifest(routes.manifest)
+    registry = coroweb.RouteRegistry()
+    registry.scan(*routes.modules)
+    return registry
+
+
+# best-effort warm-up phases, the server is ready without them; the pool prefill is required
+OPTIONAL_PHASES = ("templates", "prime_cache")
+
+
+def warmup_phases(app, loop, maxsize):
+    """
+    :return: dict of warm-up phase name -> awaitable, run concurrently after the server is listening
+    """
+    options = configs.warmup
+    phases = {}
+    if options.pool:
+        phases["pool_prefill"] = orm.prefill_pools(min(options.pool, maxsize))
+    if options.templates:
+        # compiling is cpu bound, the thread overlaps it with connecting
+        phases["templates"] = loop.run_in_executor(None, precompile_templates, app["__templating__"])
+    if options.prime:
+        phases["prime_cache"] = warmup.prime_models(options.prime, options.prime_limit)
+    return phases
+
+
+async def init(loop, workers=1):
+    """
+    init and start server
+    :param loop: event loop
+    :param workers: number of worker processes sharing the port and the db connection budget
+    :return: server, web.Application, request handler factory
+    """
+    started = time.monotonic()
+    replicas = [dict(r, db=r["database"]) if "database" in r else r for r in configs.db.replicas]
+    # each worker gets its share of the connection budget
+    maxsize = max(1, configs.db.maxsize // workers)
+    adaptive = dict(configs.db.adaptive)
+    for bound in ("min", "max"):
+        if bound in adaptive:
+            adaptive[bound] = max(1, adaptive[bound] // workers)
+    await orm.create_connection_pool(loop, backend=configs.db.backend, path=configs.db.path,
+                                     user=configs.db.user, password=configs.db.password, db=configs.db.database,
+                                     host=configs.db.host, port=configs.db.port, replicas=replicas,
+                                     balance=configs.db.balance, sticky=configs.db.sticky,
+                                     minsize=min(configs.db.minsize, maxsize), maxsize=maxsize,
+                                     adaptive=adaptive)
+    warmup.mark("pool", time.monotonic() - started)
+    start = time.monotonic()
+    coroweb.MAX_BODY = configs.web.max_body
+    middlewares = [logger_factory, cache_factory, response_factory]
+    if configs.trace.enabled:
+        tracing.setup(configs.trace.recent, configs.trace.debug, configs.trace.profile)
+        middlewares.insert(1, trace_factory)
+    with warnings.catch_warnings():
+        # custom routers are deprecated by aiohttp but still supported, see coroweb.Router
+        warnings.filterwarnings("ignore", "router argument is deprecated", DeprecationWarning)
+        app = web.Application(loop=loop, router=coroweb.Router(), middlewares=middlewares,
+                              client_max_size=configs.web.max_body)
+    encoder.use(configs.web.json)
+    assets.add_static(app, os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"),
+                      configs.assets.build_dir, configs.assets.brotli)
+    init_jinja2(app, filters={"datetime": datetime_filter}, globals={"static_url": assets.static_url},
+                production=configs.templates.production,
+                bytecode_cache=configs.templates.bytecode_cache)
+    load_routes().register(app)
+    warmup.mark("app", time.monotonic() - start)
     host = configs.web.host
     port = configs.web.port
-    srv = await loop.create_server(app.make_handler(), host, port)
-    logging.info("Server is running at http://%s:%s" % (host, port))
-    return srv
+    handler = app.make_handler()
+    srv = await loop.create_server(handler, host, port, reuse_port=workers > 1)
+    logging.info("Server is running at http://%s:%s (pid %s)" % (host, port, os.getpid()))
+    warmup.start(warmup_phases(app, loop, maxsize), started, OPTIONAL_PHASES)
+    return srv, app, handler
+
+
+async def shutdown(srv, app, handler, timeout=10):
+    """
+    stop accepting, finish running requests within timeout, then close app and db pools
+    """
+    warmup.cancel()
+    srv.close()
+    await srv.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(timeout)
+    await app.cleanup()
+    await orm.close_connection_pool()
+
+
+def setup_logging():
+    """
+    access log and log handlers on a listener thread, access records are dropped when disabled
+    """
+    log = configs.log
+    level = getattr(logging, log.level) if log.access else logging.CRITICAL + 1
+    accesslog.setup(level, log.sample_rate, log.slow_ms, log.file)
 
 
-def run_server():
+def run_server(workers=1):
+    if workers > 1:
+        return run_supervisor(workers)
+    setup_logging()
     loop = asyncio.get_event_loop()
     loop.run_until_complete(init(loop))
+    try:
+        loop.run_forever()
+    finally:
+        accesslog.stop()
+
+
+async def _dump_metrics(interval):
+    while True:
+        metrics.dump()
+        await asyncio.sleep(interval)
+
+
+def run_worker(index, workers, metrics_dir):
+    """
+    worker process: serve on the shared port until SIGTERM, then shut down gracefully
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    setup_logging()
+    metrics.workers_dir = metrics_dir
+    metrics.worker_name = str(index)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    srv, app, handler = loop.run_until_complete(init(loop, workers))
+
+    def stop():
+        # the first signal starts shutdown, later ones (e.g. SIGINT of the terminal and SIGTERM of the supervisor)
+        # are ignored instead of stopping the loop while shutdown runs on it
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+            signal.signal(sig, signal.SIG_IGN)
+        loop.stop()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop)
+    dumper = loop.create_task(_dump_metrics(configs.web.metrics_interval))
     loop.run_forever()
+    logging.info("Worker %s (pid %s) shutting down" % (index, os.getpid()))
+    dumper.cancel()
+    loop.run_until_complete(shutdown(srv, app, handler, configs.web.shutdown_timeout))
+    loop.close()
+    accesslog.stop()
+
+
+def run_supervisor(workers):
+    """
+    start workers bound with SO_REUSEPORT and respawn crashed ones.
+    SIGTERM/SIGINT stop workers gracefully, SIGHUP restarts them one by one.
+    """
+    metrics_dir = configs.web.metrics_dir or os.path.join(tempfile.gettempdir(), "awesome-metrics-%s" % os.getpid())
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in os.listdir(metrics_dir):
+        os.remove(os.path.join(metrics_dir, path))
+    procs = {}
+    state = dict(stopping=False, restart=False)
+
+    def spawn(index):
+        p = multiprocessing.Process(target=run_worker, args=(index, workers, metrics_dir), name="worker-%s" % index)
+        p.start()
+        procs[index] = p
+        logging.info("Started worker %s (pid %s)" % (index, p.pid))
+
+    def stop(p):
+        p.terminate()
+        wait(p)
+
+    def wait(p):
+        p.join(configs.web.shutdown_timeout + 5)
+        if p.is_alive():
+            logging.warning("Killing worker pid %s" % p.pid)
+            p.kill()
+            p.join()
+
+    signal.signal(signal.SIGTERM, lambda *args: state.update(stopping=True))
+    signal.signal(signal.SIGINT, lambda *args: state.update(stopping=True))
+    signal.signal(signal.SIGHUP, lambda *args: state.update(restart=True))
+    for i in range(workers):
+        spawn(i)
+    while not state["stopping"]:
+        time.sleep(0.5)
+        if state["restart"]:
+            state["restart"] = False
+            logging.info("Restarting workers...")
+            for i in range(workers):
+                old = procs[i]
+                # the new worker binds the same port before the old one stops accepting
+                spawn(i)
+                time.sleep(1)
+                stop(old)
+        for i, p in list(procs.items()):
+            if not p.is_alive() and not state["stopping"]:
+                logging.warning("Worker %s (pid %s) exited with %s, respawning" % (i, p.pid, p.exitcode))
+                spawn(i)
+    logging.info("Stopping %s workers..." % workers)
+    # one SIGTERM each, workers shut down in parallel
+    for p in procs.values():
+        p.terminate()
+    for p in procs.values():
+        wait(p)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="awesome python3 webapp server")
+    parser.add_argument("--workers", type=int, default=configs.web.workers,
+                        help="worker processes sharing the port with SO_REUSEPORT")
+    parser.add_argument("--routes", action="store_true",
+                        help="print route table and write route manifest when configured, then exit")
+    args = parser.parse_args()
+    if args.routes:
+        registry = coroweb.RouteRegistry()
+        registry.scan(*configs.web.routes.modules)
+        print(registry.dump())
+        if configs.web.routes.manifest:
+            registry.save_manifest(configs.web.routes.manifest)
+        raise SystemExit()
     try:
-        run_server()
+        run_server(args.workers)
     except KeyboardInterrupt:
         logging.info("Press ctrl+c shutting down server")
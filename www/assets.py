@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import stat
+import tempfile
+import time
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__author__ = "Vic Yue"
+
+""" static asset pipeline: fingerprinted file names, precompressed .gz/.br siblings and immutable caching """
+
+# logical path -> Asset, fingerprinted path -> Asset
+manifest = {}
+_fingerprinted = {}
+# url prefix of static files
+PREFIX = "/static/"
+# cache seconds of fingerprinted files, unfingerprinted paths are revalidated
+MAX_AGE = 365 * 24 * 3600
+# content types worth compressing besides text/*
+COMPRESSIBLE = ("application/javascript", "application/json", "application/xml", "image/svg+xml",
+                "application/wasm", "application/manifest+json")
+
+
+class Asset(object):
+    __slots__ = ("path", "url_path", "file", "encodings")
+
+    def __init__(self, path, url_path, file, encodings):
+        self.path = path
+        self.url_path = url_path
+        self.file = file
+        self.encodings = encodings
+
+    def to_dict(self):
+        return dict(url=PREFIX + self.url_path, file=self.file, encodings=self.encodings)
+
+
+def _compressible(path):
+    content_type, encoding = mimetypes.guess_type(path)
+    if content_type is None or encoding is not None:
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE
+
+
+def _write(path, data):
+    # files are replaced atomically, workers may build at the same time
+    with open(path + ".tmp%s" % os.getpid(), "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp%s" % os.getpid(), path)
+
+
+def _verified(path, data, decode=None):
+    """
+    whether the built file holds data, after decode for compressed siblings
+    """
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        return (decode(content) if decode is not None else content) == data
+    except Exception:
+        # missing, unreadable or corrupt, built again
+        return False
+
+
+def _write_compressed(path, data, compressed):
+    """
+    :return: whether the compressed sibling is kept
+    """
+    if len(compressed) < len(data):
+        _write(path, compressed)
+        return True
+    if os.path.exists(path):
+        os.remove(path)
+    return False
+
+
+def _private_dir():
+    """
+    per-user build directory in system temp directory, refused when another user owns it or can write it
+    """
+    if not hasattr(os, "getuid"):
+        return tempfile.mkdtemp(prefix="awesome-assets-")
+    path = os.path.join(tempfile.gettempdir(), "awesome-assets-%s" % os.getuid())
+    try:
+        os.mkdir(path, stat.S_IRWXU)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if st.st_uid != os.getuid() or not stat.S_ISDIR(st.st_mode) or stat.S_IMODE(st.st_mode) != stat.S_IRWXU:
+        raise RuntimeError("Unsafe asset build directory: %s" % path)
+    return path
+
+
+def build(source, target=None, use_brotli=True, gzip_level=9):
+    """
+    fingerprint static files into target directory, with .gz and .br siblings of compressible files.
+    Files already built with the same content are kept, so restarts only compress changed files,
+    other existing files are rewritten.
+    :param source: static directory
+    :param target: build directory, default a per-user directory in system temp directory
+    :param use_brotli: produce .br when brotli is installed
+    :param gzip_level: gzip compression level
+    :return: manifest dict of logical path -> Asset
+    """
+    global manifest, _fingerprinted
+    start = time.monotonic()
+    target = target or _private_dir()
+    assets = {}
+    for root, dirs, files in os.walk(source):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.startswith("."):
+                continue
+            src = os.path.join(root, name)
+            path = os.path.relpath(src, source).replace(os.sep, "/")
+            with open(src, "rb") as f:
+                data = f.read()
+            base, ext = os.path.splitext(path)
+            url_path = "%s.%s%s" % (base, hashlib.sha1(data).hexdigest()[:12], ext)
+            file = os.path.join(target, url_path)
+            encodings = []
+            if not _verified(file, data):
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                _write(file, data)
+            if _compressible(path):
+                if brotli is not None and use_brotli:
+                    if _verified(file + ".br", data, brotli.decompress) \
+                            or _write_compressed(file + ".br", data, brotli.compress(data)):
+                        encodings.append("br")
+                elif os.path.exists(file + ".br"):
+                    # FileResponse serves any sibling it finds
+                    os.remove(file + ".br")
+                if _verified(file + ".gz", data, gzip.decompress) \
+                        or _write_compressed(file + ".gz", data, gzip.compress(data, gzip_level, mtime=0)):
+                    encodings.append("gzip")
+            assets[path] = Asset(path, url_path, file, encodings)
+    manifest = assets
+    _fingerprinted = {a.url_path: a for a in assets.values()}
+    _write(os.path.join(target, "manifest.json"),
+           json.dumps({p: a.to_dict() for p, a in assets.items()}, indent=1).encode())
+    logging.info("built %s static assets to %s in %.3fs" % (len(assets), target, time.monotonic() - start))
+    return manifest
+
+
+def static_url(path):
+    """
+    url of static file, fingerprinted when it is in manifest, for templates
+    :param path: path relative to static directory, e.g. css/app.css
+    :return: str
+    """
+    asset = manifest.get(path.lstrip("/"))
+    return PREFIX + (asset.url_path if asset is not None else path.lstrip("/"))
+
+
+async def serve(request):
+    """
+    serve fingerprinted files with immutable caching, and logical paths with revalidation.
+    FileResponse picks the .br/.gz sibling by Accept-Encoding and sends it with sendfile.
+    """
+    path = request.match_info["path"]
+    asset = _fingerprinted.get(path)
+    if asset is not None:
+        cache_control = "public, max-age=%s, immutable" % MAX_AGE
+    else:
+        asset = manifest.get(path)
+        if asset is None:
+            raise web.HTTPNotFound()
+        cache_control = "no-cache"
+    headers = {"Cache-Control": cache_control}
+    if asset.encodings:
+        headers["Vary"] = "Accept-Encoding"
+    return web.FileResponse(asset.file, headers=headers)
+
+
+def add_static(app, source, target=None, use_brotli=True):
+    """
+    build static assets and route PREFIX to them
+    """
+    build(source, target, use_brotli)
+    app.router.add_get(PREFIX + "{path:.+}", serve)
+    logging.info("add static %s -> %s." % (PREFIX, source))
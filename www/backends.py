@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import logging
+
+import aiomysql
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+__author__ = "Vic Yue"
+
+""" database backends under orm: connection pools, cursor classes and placeholder style of each driver """
+
+
+class Backend(object):
+    """
+    Base backend. Pools follow the aiomysql.Pool interface used by orm: acquire, release, size, freesize,
+    minsize, maxsize, close and wait_closed. Connections follow aiomysql.Connection: cursor, begin, commit, rollback.
+    """
+    name = None
+    # cursor classes passed to connection.cursor() for dict rows, tuple rows, streamed dict and tuple rows
+    dict_cursor = None
+    tuple_cursor = None
+    stream_cursor = None
+    stream_tuple_cursor = None
+    # statement of approximate table rows by table name, None when the backend has no table statistics
+    approx_count_sql = None
+
+    def translate(self, sql):
+        """
+        translate `?` placeholder of orm statements to the driver's placeholder
+        """
+        return sql
+
+    def pool_options(self, kw):
+        """
+        :param kw: connection pool kwargs of orm.create_connection_pool
+        :return: list of (pool name, pool kwargs), the first one is the primary pool, the rest are read pools
+        """
+        raise NotImplementedError()
+
+    async def create_pool(self, loop, **kw):
+        raise NotImplementedError()
+
+
+class MySQLBackend(Backend):
+    """
+    MySQL backend of aiomysql pools, replicas are read pools
+    """
+    name = "mysql"
+    dict_cursor = aiomysql.DictCursor
+    tuple_cursor = aiomysql.Cursor
+    stream_cursor = aiomysql.SSDictCursor
+    stream_tuple_cursor = aiomysql.SSCursor
+    approx_count_sql = "SELECT `TABLE_ROWS` _num_ FROM information_schema.TABLES " \
+                       "WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=?"
+
+    def translate(self, sql):
+        return sql.replace("?", "%s")
+
+    def pool_options(self, kw):
+        options = [("primary", kw)]
+        for i, replica in enumerate(kw.get("replicas") or ()):
+            replica_kw = dict(kw)
+            replica_kw.update(replica)
+            logging.info("Creating replica connection pool: %s:%s" % (replica_kw.get("host"),
+                                                                      replica_kw.get("port", 3306)))
+            options.append(("replica%s" % i, replica_kw))
+        return options
+
+    async def create_pool(self, loop, **kw):
+        return await aiomysql.create_pool(
+            host=kw.get("host", "localhost"),
+            port=kw.get("port", 3306),
+            user=kw["user"],
+            password=kw["password"],
+            db=kw["db"],
+            charset=kw.get("charset", "utf8"),
+            autocommit=kw.get("autocommit", True),
+            maxsize=kw.get("maxsize", 10),
+            minsize=kw.get("minsize", 1),
+            loop=loop
+        )
+
+
+class SQLiteCursor(object):
+    """
+    aiosqlite cursor with aiomysql cursor methods, rows are dicts unless tuples is set
+    """
+
+    def __init__(self, conn, tuples=False):
+        self._conn = conn
+        self._cur = None
+        self._names = None
+        self.tuples = tuples
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        self._cur = await self._conn.cursor()
+        return self
+
+    async def __aexit__(self, *args):
+        await self._cur.close()
+
+    async def execute(self, sql, args=()):
+        await self._cur.execute(sql, args)
+        self.rowcount = self._cur.rowcount
+        description = self._cur.description
+        self._names = [d[0] for d in description] if description else None
+
+    async def executemany(self, sql, args):
+        await self._cur.executemany(sql, args)
+        self.rowcount = self._cur.rowcount
+
+    def _rows(self, rows):
+        if self.tuples or self._names is None:
+            return rows
+        names = self._names
+        return [dict(zip(names, r)) for r in rows]
+
+    async def fetchall(self):
+        return self._rows(await self._cur.fetchall())
+
+    async def fetchmany(self, size=None):
+        return self._rows(await self._cur.fetchmany(size))
+
+    async def fetchone(self):
+        rows = self._rows(await self._cur.fetchmany(1))
+        return rows[0] if rows else None
+
+
+class SQLiteConnection(object):
+    """
+    aiosqlite connection in autocommit mode, transactions are explicit
+    """
+
+    def __init__(self, conn, readonly=False):
+        self._conn = conn
+        self.readonly = readonly
+        self.closed = False
+
+    def cursor(self, cls=None):
+        return SQLiteCursor(self._conn, tuples=cls is tuple)
+
+    async def begin(self):
+        # take the write lock up front, a deferred transaction fails to upgrade when another one wrote meanwhile
+        await self._conn.execute("BEGIN" if self.readonly else "BEGIN IMMEDIATE")
+
+    async def commit(self):
+        await self._conn.execute("COMMIT")
+
+    async def rollback(self):
+        await self._conn.execute("ROLLBACK")
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            asyncio.ensure_future(self._conn.close())
+
+    async def ensure_closed(self):
+        if not self.closed:
+            self.closed = True
+            await self._conn.close()
+
+
+class SQLitePool(object):
+    """
+    Pool of aiosqlite connections with the aiomysql.Pool interface used by orm,
+    maxsize is the bound of the free connection deque like aiomysql
+    """
+
+    def __init__(self, path, minsize=1, maxsize=10, readonly=False, busy_timeout=5000):
+        self.path = path
+        self.readonly = readonly
+        self.busy_timeout = busy_timeout
+        self._minsize = minsize
+        self._free = collections.deque(maxlen=maxsize)
+        self._used = set()
+        self._opening = 0
+        self._cond = asyncio.Condition()
+        self._closing = False
+
+    @property
+    def minsize(self):
+        return self._minsize
+
+    @property
+    def maxsize(self):
+        return self._free.maxlen
+
+    @property
+    def size(self):
+        return len(self._free) + len(self._used) + self._opening
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path, isolation_level=None)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute("PRAGMA busy_timeout=%d" % self.busy_timeout)
+        if self.readonly:
+            await conn.execute("PRAGMA query_only=1")
+        return SQLiteConnection(conn, self.readonly)
+
+    async def fill(self):
+        async with self._cond:
+            while self.size < self.minsize:
+                self._free.append(await self._connect())
+
+    async def acquire(self):
+        if self._closing:
+            raise RuntimeError("Cannot acquire connection after closing pool")
+        async with self._cond:
+            while True:
+                if self._free:
+                    conn = self._free.popleft()
+                    self._used.add(conn)
+                    return conn
+                if self.size < self.maxsize:
+                    self._opening += 1
+                    try:
+                        conn = await self._connect()
+                    finally:
+                        self._opening -= 1
+                    self._used.add(conn)
+                    return conn
+                await self._cond.wait()
+
+    async def release(self, conn):
+        self._used.discard(conn)
+        if not conn.closed and conn.in_transaction:
+            await conn.rollback()
+        if self._closing or conn.closed or len(self._free) >= self.maxsize:
+            await conn.ensure_closed()
+        else:
+            self._free.append(conn)
+        async with self._cond:
+            self._cond.notify()
+
+    def close(self):
+        self._closing = True
+
+    async def wait_closed(self):
+        while self._free:
+            await self._free.popleft().ensure_closed()
+        async with self._cond:
+            while self._used:
+                await self._cond.wait()
+
+
+class SQLiteBackend(Backend):
+    """
+    Embedded SQLite backend in WAL mode: one writer connection as primary pool, and a pool of read only
+    connections as read pool. WAL readers don't block the writer and see every committed write.
+    """
+    name = "sqlite"
+    tuple_cursor = tuple
+    stream_tuple_cursor = tuple
+
+    def pool_options(self, kw):
+        if aiosqlite is None:
+            raise RuntimeError("SQLite backend requires aiosqlite")
+        return [("primary", dict(kw, minsize=1, maxsize=1, readonly=False)),
+                ("reader", dict(kw, readonly=True))]
+
+    async def create_pool(self, loop, **kw):
+        pool = SQLitePool(kw.get("path") or "awesome.db", kw.get("minsize", 1), kw.get("maxsize", 10),
+                          kw.get("readonly", False), kw.get("busy_timeout", 5000))
+        await pool.fill()
+        return pool
+
+
+BACKENDS = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
+
+
+def get(name):
+    """
+    :param name: mysql or sqlite
+    :return: Backend
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown database backend: %s" % name)
+    return BACKENDS[name]()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from collections import OrderedDict
+
+__author__ = "Vic Yue"
+
+""" in-process cache with ttl and lru eviction """
+
+# registered caches by name, used by monitoring
+caches = {}
+
+
+class LRUCache(object):
+    """
+    Bounded cache, entries expire after ttl seconds and the least recently used entry is evicted when full.
+    Concurrent misses of the same key are collapsed into one load.
+    """
+
+    def __init__(self, ttl=60, maxsize=10000, name=None):
+        assert maxsize > 0
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._loading = {}
+        if name is not None:
+            caches[name] = self
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expire_at, value = item
+        if self.ttl and expire_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + (self.ttl or 0), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def keys(self):
+        return list(self._data.keys())
+
+    def update(self, key, fn):
+        """
+        replace cached value by fn(value) keeping its expire time, do nothing when not cached
+        """
+        item = self._data.get(key)
+        if item is not None:
+            self._data[key] = (item[0], fn(item[1]))
+        # a running load may miss the change
+        self._loading.pop(key, None)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+        # a running load must not store the stale value
+        self._loading.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._loading.clear()
+
+    async def get_or_load(self, key, loader):
+        """
+        get value by key, load and cache it on miss
+        :param key: cache key
+        :param loader: no-arguments coroutine function, None result is not cached
+        :return: value
+        """
+        missing = self._loading
+        while True:
+            value = self.get(key, missing)
+            if value is not missing:
+                return value
+            fut = self._loading.get(key)
+            if fut is None:
+                break
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # the loading caller was cancelled, not this one: load again
+        fut = asyncio.get_event_loop().create_future()
+        self._loading[key] = fut
+        try:
+            value = await loader()
+        except BaseException as e:
+            if self._loading.get(key) is fut:
+                del self._loading[key]
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                # mark retrieved, waiters get the exception by themselves
+                fut.exception()
+            raise
+        if self._loading.get(key) is fut:
+            del self._loading[key]
+            if value is not None:
+                self.set(key, value)
+        fut.set_result(value)
+        return value
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self._data),
+                    maxsize=self.maxsize, ttl=self.ttl)
+
+
+def stats():
+    """
+    stats of all registered caches
+    :return: dict of cache name -> stats
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
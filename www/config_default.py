@@ -7,15 +7,96 @@ __author__ = "Vic Yue"
 
 configs = {
     "db": {
+        # mysql, or sqlite (requires aiosqlite) with database file path, one writer and maxsize readers in WAL mode
+        "backend": "mysql",
+        "path": "awesome.db",
         "host": "127.0.0.1",
         "port": 3306,
         "user": "root",
         "password": "usbw",
-        "database": "qjcg"
+        "database": "qjcg",
+        # read only replicas, e.g. [{"host": "127.0.0.1", "port": 3307}], missing keys are taken from primary
+        "replicas": [],
+        # replica balance: round_robin or least_busy
+        "balance": "round_robin",
+        # seconds to read from primary after a write in the same request
+        "sticky": 1,
+        "minsize": 1,
+        "maxsize": 10,
+        # grow/shrink maxsize between min and max by observed acquire queue depth
+        "adaptive": {
+            "enabled": False,
+            "min": 5,
+            "max": 30,
+            "interval": 5
+        }
     },
     "web": {
         "host": "127.0.0.1",
-        "port": 9000
+        "port": 9000,
+        # json encoder: orjson, ujson, json, or None for the fastest installed
+        "json": None,
+        # worker processes, db maxsize is shared between workers
+        "workers": 1,
+        # seconds for running requests to finish on shutdown
+        "shutdown_timeout": 10,
+        # max request body bytes, routes override it with @url_route(max_body=)
+        "max_body": 1024 * 1024,
+        # per-worker metrics directory, None for system temp directory; and dump interval seconds
+        "metrics_dir": None,
+        "metrics_interval": 5,
+        "routes": {
+            # handler modules or packages scanned for @url_route
+            "modules": ["handlers"],
+            # route manifest written by app.py --routes, with lazy set handler modules are imported on first hit
+            "manifest": None,
+            "lazy": False
+        }
+    },
+    "warmup": {
+        # connections opened in each pool after startup, 0 to skip
+        "pool": 5,
+        # compile all templates after startup
+        "templates": True,
+        # models whose find cache is primed, e.g. ["models.User"], and max objects of each
+        "prime": [],
+        "prime_limit": 1000
+    },
+    "assets": {
+        # fingerprinted and precompressed static files directory, None for a per-user temp directory
+        "build_dir": None,
+        # produce .br files when brotli is installed
+        "brotli": True
+    },
+    "templates": {
+        # production mode: no auto reload, bytecode cache and async rendering
+        "production": False,
+        # bytecode cache directory, None for jinja2's per-user temp directory
+        "bytecode_cache": None
+    },
+    "log": {
+        # access log of each request: method, path, status, latency and db time as json lines
+        "access": True,
+        "level": "INFO",
+        # sample rate of normal requests, errors and requests slower than slow_ms are always logged
+        "sample_rate": 1.0,
+        "slow_ms": 500,
+        # access log file, None for stderr
+        "file": None
+    },
+    "trace": {
+        # request spans of handler, sql, pool acquire and template render, sent as Server-Timing header
+        "enabled": True,
+        # expose recent traces and kept profiles on /debug/traces, and number of recent traces
+        "debug": False,
+        "recent": 100,
+        # cProfile sampled requests, profiles of the slowest top requests per route are kept in dir
+        "profile": {
+            "enabled": False,
+            "rate": 0.01,
+            "top": 10,
+            "dir": None
+        }
     },
     "session": {
         "secret": "AwEs0mE"
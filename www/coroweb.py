@@ -3,34 +3,53 @@
 
 import asyncio
 import functools
+import importlib
 import inspect
+import json
 import logging
-import os
+import pkgutil
+import time
 from urllib import parse
 
-from aiohttp import web
+from aiohttp import hdrs, web
+from aiohttp.web_urldispatcher import UrlMappingMatchInfo
+from multidict import MultiDict
 
+import tracing
 from apis import APIError
 
 __author__ = "Vic Yue"
 
 
-def url_route(path, method="GET"):
+def url_route(path, method="GET", cache=None, cache_models=(), cache_vary=(), max_body=None):
     """
     Define decorator @url_route("/path", method="GET")
     :param path: url deal path
     :param method: request method
+    :param cache: seconds to cache GET responses, None for no cache
+    :param cache_models: models whose writes invalidate cached responses, in the writing worker process only
+    :param cache_vary: request headers that vary cached responses
+    :param max_body: max request body bytes, default MAX_BODY
     :return:
     """
 
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kw):
-            return func(*args, **kw)
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kw):
+                return await func(*args, **kw)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kw):
+                return func(*args, **kw)
 
         assert method in ("GET", "POST", "DELETE", "PUT", "OPTION")
         wrapper.__method__ = method
         wrapper.__route__ = path
+        wrapper.__cache__ = cache
+        wrapper.__cache_models__ = tuple(cache_models)
+        wrapper.__cache_vary__ = tuple(cache_vary)
+        wrapper.__max_body__ = max_body
         return wrapper
 
     return decorator
@@ -48,7 +67,7 @@ def has_request_args(fn):
                 inspect.Parameter.VAR_POSITIONAL, inspect.Parameter.KEYWORD_ONLY, inspect.Parameter.VAR_KEYWORD)):
             raise ValueError("Request parameter must be the last named parameter in function: %s:%s"
                              % (fn.__name__, str(sign)))
-        return found
+    return found
 
 
 def has_named_kw_args(fn):
@@ -89,6 +108,245 @@ def get_required_kw_args(fn):
     return tuple(args)
 
 
+# default max request body bytes of routes
+MAX_BODY = 1024 * 1024
+# parsed body of request, shared by middlewares and handlers
+BODY_KEY = web.RequestKey("body", object)
+
+
+def _too_large(limit, size):
+    return web.HTTPRequestEntityTooLarge(max_size=limit, actual_size=size)
+
+
+async def _read(request, limit):
+    """
+    read request body, at most limit bytes
+    """
+    length = request.content_length
+    if length is not None and length > limit:
+        raise _too_large(limit, length)
+    chunks, size = [], 0
+    async for chunk in request.content.iter_any():
+        size += len(chunk)
+        if size > limit:
+            raise _too_large(limit, size)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+async def read_body(request, limit=None):
+    """
+    parse json or form body once, later calls of middlewares and handlers share the result.
+    Multipart forms are buffered by aiohttp here, use a Multipart handler argument to stream them.
+    The route limit replaces the app client_max_size, which aiohttp applies to buffered multipart forms.
+    :param request: web.Request
+    :param limit: max body bytes, default MAX_BODY
+    :return: dict of json body, MultiDict of form body
+    """
+    if BODY_KEY in request:
+        return request[BODY_KEY]
+    limit = limit or MAX_BODY
+    ct = request.content_type
+    if not ct:
+        raise web.HTTPBadRequest(text="Missing Content-Type.")
+    ct = ct.lower()
+    if ct.startswith("application/json"):
+        try:
+            data = json.loads(await _read(request, limit) or b"null")
+        except ValueError:
+            raise web.HTTPBadRequest(text="Invalid JSON body.")
+        if not isinstance(data, dict):
+            raise web.HTTPBadRequest(text="JSON body must be object.")
+    elif ct.startswith("application/x-www-form-urlencoded"):
+        body = (await _read(request, limit)).decode(request.charset or "utf-8")
+        data = MultiDict(parse.parse_qsl(body, keep_blank_values=True))
+    elif ct.startswith("multipart/form-data"):
+        if request.content_length is not None and request.content_length > limit:
+            raise _too_large(limit, request.content_length)
+        data = await request.clone(client_max_size=limit).post()
+    else:
+        raise web.HTTPBadRequest(text="Unsupported Content-Type: %s" % ct)
+    logging.debug("request body: %s", data)
+    request[BODY_KEY] = data
+    return data
+
+
+class Part(object):
+    """
+    Streamed part of a multipart form, read it before moving to the next part
+    """
+
+    def __init__(self, part, form):
+        self._part = part
+        self._form = form
+        self.name = part.name
+        self.filename = part.filename
+        self.headers = part.headers
+
+    async def read_chunk(self, size=65536):
+        """
+        :return: next chunk of part, b"" at the end
+        """
+        chunk = await self._part.read_chunk(size)
+        self._form.size += len(chunk)
+        if self._form.size > self._form.limit:
+            raise _too_large(self._form.limit, self._form.size)
+        return chunk
+
+    async def read(self):
+        chunks = []
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    async def text(self):
+        return (await self.read()).decode(self._part.get_charset("utf-8"))
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                return
+            yield chunk
+
+
+class Multipart(object):
+    """
+    Handler argument annotation of a streamed multipart/form-data body, e.g. async def upload(*, form: Multipart).
+    Parts are yielded as Part without buffering the form, the route size limit applies to all parts read.
+    """
+
+    def __init__(self, request, limit):
+        self.request = request
+        self.limit = limit
+        self.size = 0
+
+    def __aiter__(self):
+        return self._parts()
+
+    async def _parts(self):
+        length = self.request.content_length
+        if length is not None and length > self.limit:
+            raise _too_large(self.limit, length)
+        reader = await self.request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                return
+            yield Part(part, self)
+            # skip what the handler left unread of the part
+            await part.release()
+
+
+def _coerce_bool(v):
+    if isinstance(v, bool):
+        return v
+    return str(v).lower() in ("1", "true", "yes", "on")
+
+
+def _coerce_list(v):
+    return v if isinstance(v, list) else [v]
+
+
+# annotation -> converter of request argument
+COERCERS = {int: int, float: float, bool: _coerce_bool, list: _coerce_list, str: str}
+
+
+class ArgumentBinder(object):
+    """
+    Bind request arguments to handler kwargs, specialized once per handler from its signature:
+    request body and query string are only parsed when the handler takes keyword arguments,
+    values are converted by parameter annotations (int, float, bool, list, str).
+    Invalid requests raise web.HTTPBadRequest.
+    """
+
+    def __init__(self, fn):
+        params = inspect.signature(fn).parameters
+        self.has_request_arg = has_request_args(fn)
+        self.has_var_kw_arg = has_var_kw_arg(fn)
+        self.named_kw_args = get_named_kw_args(fn)
+        self.required_kw_args = get_required_kw_args(fn)
+        self.coercers = tuple((name, COERCERS[param.annotation]) for name, param in params.items()
+                              if param.annotation in COERCERS and param.kind != inspect.Parameter.VAR_KEYWORD)
+        self.multi_value = frozenset(k for k, c in self.coercers if c is _coerce_list)
+        self.multipart_arg = next((name for name, param in params.items() if param.annotation is Multipart), None)
+        self.max_body = getattr(fn, "__max_body__", None)
+        # input handlers read body or query string, the others only take path arguments and request,
+        # handlers without parameters are called without binding
+        self.reads_input = bool(self.has_var_kw_arg or self.named_kw_args or self.multipart_arg)
+        self.takes_args = bool(params)
+        self._finish_path = bool(self.coercers or self.has_request_arg)
+
+    def _pick(self, params, kw):
+        """
+        copy wanted arguments of multi dict params to kw
+        """
+        if self.has_var_kw_arg:
+            # first value of each name, like parse_qs of the legacy handler
+            kw.update(params)
+            for name in self.multi_value:
+                if name in params:
+                    kw[name] = params.getall(name)
+        else:
+            for name in self.named_kw_args:
+                if name in params:
+                    kw[name] = params.getall(name) if name in self.multi_value else params[name]
+
+    def bind_path(self, request):
+        """
+        kwargs of a handler without keyword arguments, no await needed
+        """
+        kw = dict(request.match_info)
+        return self._finish(request, kw) if self._finish_path else kw
+
+    async def bind_input(self, request):
+        kw = {}
+        if request.method == "POST":
+            if self.multipart_arg and request.content_type.lower().startswith("multipart/form-data"):
+                kw[self.multipart_arg] = Multipart(request, self.max_body or MAX_BODY)
+            else:
+                params = await read_body(request, self.max_body)
+                if isinstance(params, dict):
+                    names = params.keys() if self.has_var_kw_arg else self.named_kw_args
+                    for name in names:
+                        if name in params:
+                            kw[name] = params[name]
+                else:
+                    self._pick(params, kw)
+        elif request.method == "GET" and request.query_string:
+            self._pick(request.query, kw)
+        match_info = request.match_info
+        if match_info:
+            for k, v in match_info.items():
+                if k in kw:
+                    logging.warning("Duplicate arg in named arg and kw args: %s" % k)
+                kw[k] = v
+        return self._finish(request, kw)
+
+    def _finish(self, request, kw):
+        for name, coerce in self.coercers:
+            if name in kw:
+                try:
+                    kw[name] = coerce(kw[name])
+                except (TypeError, ValueError):
+                    raise web.HTTPBadRequest(text="Invalid argument %s: %s" % (name, kw[name]))
+        if self.has_request_arg:
+            kw["request"] = request
+        for name in self.required_kw_args:
+            if name not in kw:
+                raise web.HTTPBadRequest(text="Missing required argument: %s" % name)
+        return kw
+
+
+# kwargs of handlers without parameters, never mutated
+_NO_ARGS = {}
+
+
 class RequestHandler(object):
     """
     Web Request Handler
@@ -97,70 +355,55 @@ class RequestHandler(object):
     def __init__(self, app, fn):
         self.app = app
         self._func = fn
-        self._has_request_args = has_request_args(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self._binder = ArgumentBinder(fn)
+        # response cache options of @url_route
+        self.cache = getattr(fn, "__cache__", None)
+        self.cache_models = getattr(fn, "__cache_models__", ())
+        self.cache_vary = getattr(fn, "__cache_vary__", ())
+        _mark_coroutine(self)
 
     async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == "POST":
-                ct = request.content_type
-                if not ct:
-                    return web.HTTPBadRequest("Missing Content-Type.")
-                ct = ct.lower()
-                if ct.startswith("application/json"):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest("JSON body must be object.")
-                    kw = params
-                elif ct.startswith("application/x-www-form-urlencoded") or ct.startswith("multipart/form-data"):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest("Unsupported Content-Type: %s" % ct)
-            elif request.method == "GET":
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unnamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named args:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning("Duplicate arg in named arg and kw args: %s" % k)
-                kw[k] = v
-        if self._has_request_args:
-            kw["request"] = request
-        # check required kw
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if name not in kw:
-                    return web.HTTPBadRequest("Missing required argument: %s" % name)
-        logging.info("Call with args: %s" % str(kw))
+        binder = self._binder
+        try:
+            if binder.reads_input:
+                kw = await binder.bind_input(request)
+            elif binder.takes_args:
+                kw = binder.bind_path(request)
+            else:
+                kw = _NO_ARGS
+        except web.HTTPBadRequest as e:
+            return e
+        logging.debug("Call %s with args: %s", self._func.__name__, kw)
+        trace = tracing.current()
+        start = time.monotonic() if trace is not None else 0
         try:
-            r = await self._func(**kw)
-            return r
+            return await self._func(**kw)
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        finally:
+            if trace is not None:
+                trace.add("handler", time.monotonic() - start, self._func.__name__)
 
 
-def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
-    app.router.add_static("/static/", path)
-    logging.info("add static /static/ -> %s." % path)
+def _mark_coroutine(handler):
+    # mark as coroutine function, so aiohttp keeps this handler instead of wrapping it as a bare function
+    # that must return web.StreamResponse, results are converted by response_factory
+    if hasattr(inspect, "markcoroutinefunction"):
+        inspect.markcoroutinefunction(handler)
+    else:
+        handler._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+def _async_fn(fn):
+    if asyncio.iscoroutinefunction(fn) or inspect.isgeneratorfunction(fn):
+        return fn
+    sync_fn = fn
+
+    @functools.wraps(sync_fn)
+    async def fn(*args, **kw):
+        return sync_fn(*args, **kw)
+
+    return fn
 
 
 def add_route(app, fn):
@@ -168,8 +411,7 @@ def add_route(app, fn):
     path = getattr(fn, "__route__", None)
     if method is None or path is None:
         raise ValueError("@url_route was not defined on %s" % str(fn))
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
+    fn = _async_fn(fn)
     logging.info(
         "add router %s %s -> %s(%s)." % (method, path, fn.__name__, ", ".join(inspect.signature(fn).parameters.keys())))
     app.router.add_route(method, path, RequestHandler(app, fn))
@@ -182,15 +424,207 @@ def add_routes(app, module_name):
     :param module_name:
     :return:
     """
-    assert isinstance(module_name, str)
-    modules = module_name.split(".")
-    if len(modules) == 1:
-        mod = __import__(modules[0], globals(), locals())
-    else:
-        mod = getattr(__import__(modules[0], globals(), locals(), (modules[1])), modules[1])
-    for attr in dir(mod):
-        if attr.startswith("_"):
-            continue
-        fn = getattr(mod, attr)
-        if callable(fn) and hasattr(fn, "__method__") and hasattr(fn, "__route__"):
-            add_route(app, fn)
+    registry = RouteRegistry()
+    registry.scan(module_name)
+    registry.register(app)
+    return registry
+
+
+class LazyHandler(object):
+    """
+    Handler of a route manifest entry, its module is imported on first hit
+    """
+
+    def __init__(self, app, module, name):
+        self.app = app
+        self.module = module
+        self.name = name
+        self._handler = None
+        _mark_coroutine(self)
+
+    def load(self):
+        """
+        import handler module and build its RequestHandler
+        :return: RequestHandler
+        """
+        if self._handler is None:
+            fn = getattr(importlib.import_module(self.module), self.name)
+            self._handler = RequestHandler(self.app, _async_fn(fn))
+            logging.info("lazy loaded route handler %s.%s" % (self.module, self.name))
+        return self._handler
+
+    @property
+    def cache(self):
+        return self.load().cache
+
+    @property
+    def cache_models(self):
+        return self.load().cache_models
+
+    @property
+    def cache_vary(self):
+        return self.load().cache_vary
+
+    async def __call__(self, request):
+        return await self.load()(request)
+
+
+def _route_key(path):
+    """
+    sort key of registration: static paths first, then parameterized paths with more literal segments first
+    """
+    segments = [s for s in path.split("/") if s]
+    dynamic = [i for i, s in enumerate(segments) if "{" in s]
+    if not dynamic:
+        return 0, 0, 0, path
+    return 1, -dynamic[0], -(len(segments) - len(dynamic)), path
+
+
+def _route_shape(path):
+    """
+    path with parameter names dropped, /blog/{id} and /blog/{name} have the same shape
+    """
+    return "/".join("{}" if "{" in s else s for s in path.split("/"))
+
+
+class RouteRegistry(object):
+    """
+    Collect @url_route handlers of modules and packages, check conflicts and register them in match order.
+    A route manifest of (method, path, module, name) lets handler modules be imported lazily on first hit.
+    """
+
+    def __init__(self):
+        # (method, path) -> (module, name, fn), fn is None for lazy entries from manifest
+        self.routes = {}
+        self._shapes = {}
+
+    def add(self, fn=None, method=None, path=None, module=None, name=None):
+        """
+        add a handler function, or a lazy handler by module and name
+        :raise ValueError: on duplicated route or parameterized routes of the same shape
+        """
+        if fn is not None:
+            method, path = fn.__method__, fn.__route__
+            module, name = fn.__module__, fn.__name__
+        key = (method, path)
+        if fn is not None and key in self.routes and self.routes[key][2] is fn:
+            # the same handler imported into several scanned modules
+            return
+        shape = (method, _route_shape(path))
+        if key in self.routes:
+            raise ValueError("route conflict %s %s: %s.%s and %s.%s" % (method, path, module, name,
+                                                                         *self.routes[key][:2]))
+        if shape in self._shapes:
+            other = self._shapes[shape]
+            raise ValueError("route conflict %s %s: same pattern as %s of %s.%s" % (method, path, other[1],
+                                                                                   *self.routes[other][:2]))
+        self.routes[key] = (module, name, fn)
+        self._shapes[shape] = key
+
+    def scan(self, *module_names):
+        """
+        collect handlers of modules, packages are scanned with their sub modules
+        :param module_names: dotted module or package names
+        """
+        for module_name in module_names:
+            mod = importlib.import_module(module_name)
+            mods = [mod]
+            if hasattr(mod, "__path__"):
+                for info in pkgutil.walk_packages(mod.__path__, mod.__name__ + "."):
+                    mods.append(importlib.import_module(info.name))
+            for m in mods:
+                for attr in dir(m):
+                    if attr.startswith("_"):
+                        continue
+                    fn = getattr(m, attr)
+                    if callable(fn) and hasattr(fn, "__method__") and hasattr(fn, "__route__"):
+                        self.add(fn)
+
+    def table(self):
+        """
+        :return: list of (method, path, handler) in registration order
+        """
+        return [(method, path, "%s.%s" % self.routes[(method, path)][:2])
+                for method, path in sorted(self.routes, key=lambda k: (_route_key(k[1]), k[0]))]
+
+    def dump(self):
+        """
+        :return: route table as text
+        """
+        rows = self.table()
+        width = max([len(path) for _, path, _ in rows] + [4])
+        lines = ["%-7s %-*s %s" % ("METHOD", width, "PATH", "HANDLER")]
+        lines.extend("%-7s %-*s %s" % (method, width, path, handler) for method, path, handler in rows)
+        return "\n".join(lines)
+
+    def save_manifest(self, path):
+        with open(path, "w") as f:
+            json.dump([dict(method=method, path=route, module=self.routes[(method, route)][0],
+                            name=self.routes[(method, route)][1]) for method, route, _ in self.table()], f, indent=1)
+
+    @classmethod
+    def load_manifest(cls, path):
+        """
+        :return: RouteRegistry of lazy entries
+        """
+        registry = cls()
+        with open(path) as f:
+            for entry in json.load(f):
+                registry.add(method=entry["method"], path=entry["path"], module=entry["module"], name=entry["name"])
+        return registry
+
+    def register(self, app):
+        """
+        add routes to app router, static paths first
+        """
+        for method, path, _ in self.table():
+            module, name, fn = self.routes[(method, path)]
+            if fn is None:
+                app.router.add_route(method, path, LazyHandler(app, module, name))
+            else:
+                add_route(app, fn)
+        logging.info("registered %s routes" % len(self.routes))
+
+
+async def _resolved(match_info):
+    return match_info
+
+
+class Router(web.UrlDispatcher):
+    """
+    UrlDispatcher resolving static paths by a dict lookup, built when the app is frozen,
+    before walking the resource index.
+    It relies on two aiohttp hooks outside the stable API: web.Application(router=...), deprecated but
+    still supported, and UrlMappingMatchInfo of aiohttp.web_urldispatcher, which the stock resolve builds
+    the same way. tests/test_coroweb.py resolves static, parameterized, 404 and 405 requests through
+    a real app to catch changes of either on aiohttp upgrades.
+    """
+    # static paths needed for the fast path, with fewer of them the stock resolve is kept, as the lookup
+    # adds a dict miss to every parameterized route
+    FAST_PATH_MIN = 16
+
+    def __init__(self):
+        super().__init__()
+        # path -> {method: route}
+        self._static = {}
+
+    def freeze(self):
+        super().freeze()
+        self._static = {}
+        for resource in self._resources:
+            if isinstance(resource, web.PlainResource):
+                routes = self._static.setdefault(resource.canonical, {})
+                for route in resource:
+                    routes.setdefault(route.method, route)
+        if len(self._static) < self.FAST_PATH_MIN:
+            self._static = {}
+            self.resolve = super().resolve
+
+    def resolve(self, request):
+        routes = self._static.get(request.rel_url.path_safe)
+        if routes is not None:
+            route = routes.get(request.method) or routes.get(hdrs.METH_ANY)
+            if route is not None:
+                return _resolved(UrlMappingMatchInfo({}, route))
+        # the dispatcher coroutine is returned as is, without another coroutine frame for dynamic routes
+        return web.UrlDispatcher.resolve(self, request)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import datetime
+import decimal
+import json
+import logging
+
+from aiohttp import web
+
+from orm import Row
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+__author__ = "Vic Yue"
+
+""" pluggable json encoder, orjson or ujson when installed, stdlib json otherwise """
+
+# json content type of responses
+CONTENT_TYPE = "application/json;charset=utf-8"
+
+
+def _default(o):
+    """
+    encode types json libraries don't know, there is no __dict__ fallback
+    """
+    if isinstance(o, Row):
+        return dict(zip(o.__slots__, o.values()))
+    if isinstance(o, (datetime.datetime, datetime.date)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (set, frozenset, tuple)):
+        return list(o)
+    if hasattr(o, "to_dict"):
+        return o.to_dict()
+    raise TypeError("Object of type %s is not JSON serializable" % o.__class__.__name__)
+
+
+def _orjson_dumps(obj):
+    # Model is a dict subclass, orjson encodes it natively
+    return orjson.dumps(obj, default=_default)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, default=_default).encode()
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=_default, separators=(",", ":")).encode()
+
+
+ENCODERS = {"json": _json_dumps}
+if ujson is not None:
+    ENCODERS["ujson"] = _ujson_dumps
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson_dumps
+
+# fastest installed encoder
+DEFAULT_ENCODER = "orjson" if orjson is not None else "ujson" if ujson is not None else "json"
+
+# chosen by use() in app init, not logged at import so logging config of the app still applies
+dumps = ENCODERS[DEFAULT_ENCODER]
+
+
+def use(encoder=None):
+    """
+    choose json encoder
+    :param encoder: orjson, ujson, json, a callable returning bytes, default the fastest installed
+    :return: encoder name
+    """
+    global dumps
+    if callable(encoder):
+        dumps = encoder
+        return getattr(encoder, "__name__", "custom")
+    if encoder is None:
+        encoder = DEFAULT_ENCODER
+    if encoder not in ENCODERS:
+        raise ValueError("JSON encoder is not installed: %s" % encoder)
+    dumps = ENCODERS[encoder]
+    logging.info("use json encoder: %s" % encoder)
+    return encoder
+
+
+def json_response(obj, status=200):
+    """
+    :return: web.Response with encoded bytes as body
+    """
+    resp = web.Response(body=dumps(obj), status=status)
+    resp.content_type = CONTENT_TYPE
+    return resp
+
+
+class JSONStream(object):
+    """
+    Handler result streamed as chunked json array, for large lists of models.
+    Items is an iterable or async iterable, e.g. Model.query() or a Model.iter_all() batch generator with batches=True.
+    """
+
+    def __init__(self, items, batches=False, chunk_size=100):
+        self.items = items
+        self.batches = batches
+        self.chunk_size = chunk_size
+
+    async def _iter(self):
+        if hasattr(self.items, "__aiter__"):
+            async for item in self.items:
+                if self.batches:
+                    for obj in item:
+                        yield obj
+                else:
+                    yield item
+        else:
+            for item in self.items:
+                if self.batches:
+                    for obj in item:
+                        yield obj
+                else:
+                    yield item
+
+    async def write(self, request):
+        """
+        write items to a chunked response
+        :param request: web.Request
+        :return: web.StreamResponse
+        """
+        resp = web.StreamResponse()
+        resp.content_type = CONTENT_TYPE
+        resp.enable_chunked_encoding()
+        await resp.prepare(request)
+        chunk = [b"["]
+        first = True
+        async for obj in self._iter():
+            if not first:
+                chunk.append(b",")
+            first = False
+            chunk.append(dumps(obj))
+            if len(chunk) >= self.chunk_size * 2:
+                await resp.write(b"".join(chunk))
+                chunk = []
+        chunk.append(b"]")
+        await resp.write(b"".join(chunk))
+        await resp.write_eof()
+        return resp
@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from aiohttp import web
+
+import encoder
+import metrics
+import tracing
+import warmup
 from coroweb import url_route
 from models import User
 
@@ -9,10 +15,30 @@ __author__ = "Vic Yue"
 """ define url handler with @url_route(path, method)"""
 
 
-@url_route("/")
+@url_route("/", cache=60, cache_models=(User,))
 async def index():
     users = await User.find_all()
     return {
         "__template__": "test.html",
         "users": users
     }
+
+
+@url_route("/metrics")
+async def prometheus_metrics():
+    return web.Response(body=metrics.render_all().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+@url_route("/ready")
+async def readiness():
+    return encoder.json_response(dict(ready=warmup.ready, phases=warmup.phases, failed=warmup.failed),
+                                 200 if warmup.ready else 503)
+
+
+@url_route("/debug/traces")
+async def debug_traces():
+    if not tracing.debug:
+        raise web.HTTPNotFound()
+    profiles = tracing.profiler.slowest() if tracing.profiler is not None else {}
+    return dict(traces=tracing.recent(), profiles=profiles)
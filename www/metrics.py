@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import glob
+import json
+import os
+
+__author__ = "Vic Yue"
+
+""" in-process metrics with prometheus text exposition """
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# registered metrics in render order
+registry = []
+# directory of per-worker metrics files in multi-process mode, and this worker's name
+workers_dir = None
+worker_name = None
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % tuple(extra))
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return repr(v) if isinstance(v, float) else str(v)
+
+
+class Metric(object):
+    """
+    Base metric, values are kept per label values tuple.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        registry.append(self)
+
+    def samples(self):
+        """
+        :return: list of (name, label values, extra label, value)
+        """
+        return [(self.name, k, None, v) for k, v in self._values.items()]
+
+    def clear(self):
+        self._values.clear()
+
+    def collect(self):
+        """
+        :return: json serializable family of metric
+        """
+        return dict(name=self.name, documentation=self.documentation, kind=self.kind, labels=list(self.labels),
+                    samples=[[name, list(values), extra, value] for name, values, extra, value in self.samples()])
+
+    def render(self):
+        return _render_family(self.collect())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, value=1):
+        self._values[label_values] = self._values.get(label_values, 0) + value
+
+
+class Gauge(Metric):
+    """
+    Gauge metric, values are set directly or collected by callback on render.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self._collect = collect
+
+    def set(self, *label_values, value):
+        self._values[label_values] = value
+
+    def samples(self):
+        if self._collect is not None:
+            self._values = dict(self._collect())
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            # bucket counts (last one is +Inf), sum
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def snapshot(self, *label_values):
+        """
+        :return: dict of count, sum and cumulative buckets
+        """
+        state = self._values.get(label_values)
+        if state is None:
+            return dict(count=0, sum=0.0, buckets={})
+        cumulative, total = [], 0
+        for n in state[0]:
+            total += n
+            cumulative.append(total)
+        return dict(count=total, sum=state[1], buckets=dict(zip(self.buckets + (float("inf"),), cumulative)))
+
+    def samples(self):
+        samples = []
+        for values in self._values:
+            snap = self.snapshot(*values)
+            for le, n in snap["buckets"].items():
+                samples.append((self.name + "_bucket", values, ("le", _format_value(float(le))), n))
+            samples.append((self.name + "_sum", values, None, snap["sum"]))
+            samples.append((self.name + "_count", values, None, snap["count"]))
+        return samples
+
+
+def _render_family(family):
+    lines = ["# HELP %s %s" % (family["name"], family["documentation"]),
+             "# TYPE %s %s" % (family["name"], family["kind"])]
+    for name, values, extra, value in family["samples"]:
+        lines.append("%s%s %s" % (name, _format_labels(family["labels"], values, extra), _format_value(value)))
+    return "\n".join(lines)
+
+
+def render():
+    """
+    render all registered metrics in prometheus text format
+    :return: str
+    """
+    return "\n".join(m.render() for m in registry) + "\n"
+
+
+def dump():
+    """
+    write metrics of this worker to workers_dir
+    """
+    path = os.path.join(workers_dir, "%s.json" % worker_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump([m.collect() for m in registry], f)
+    os.replace(path + ".tmp", path)
+
+
+def render_workers():
+    """
+    render metrics of all workers in workers_dir, samples are labelled by worker
+    :return: str
+    """
+    if worker_name is not None:
+        dump()
+    merged = {}
+    for path in sorted(glob.glob(os.path.join(workers_dir, "*.json"))):
+        worker = os.path.basename(path)[:-5]
+        try:
+            with open(path) as f:
+                families = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for family in families:
+            target = merged.get(family["name"])
+            if target is None:
+                target = merged[family["name"]] = dict(family, labels=["worker"] + family["labels"], samples=[])
+            target["samples"].extend([[name, [worker] + values, extra, value]
+                                      for name, values, extra, value in family["samples"]])
+    return "\n".join(_render_family(f) for f in merged.values()) + "\n"
+
+
+def render_all():
+    """
+    render metrics of all workers in multi-process mode, of this process otherwise
+    """
+    return render_workers() if workers_dir else render()
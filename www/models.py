@@ -23,12 +23,12 @@ class User(Model):
     __table__ = "t_users"
 
     id = StringField(primary_key=True, default=business_id)
-    email = StringField(ddl="varchar(50)")
+    email = StringField(ddl="varchar(50)", unique=True)
     passwd = StringField(ddl="varchar(50)")
     admin = BooleanField()
     name = StringField(ddl="varchar(50)")
     image = StringField(ddl="varchar(255)")
-    create_at = IntegerField(default=lambda: int(time.time()))
+    create_at = IntegerField(default=lambda: int(time.time()), index=True)
 
 
 class Blog(Model):
@@ -36,6 +36,8 @@ class Blog(Model):
     Blog Model
     """
     __table__ = "t_blogs"
+    # posts of a user, newest first
+    __indexes__ = [("user_id", "create_at")]
 
     id = StringField(primary_key=True, default=business_id)
     user_id = StringField()
@@ -43,7 +45,7 @@ class Blog(Model):
     summary = StringField(ddl="varchar(200)")
     content = TextField()
     image = StringField(ddl="varchar(255)")
-    create_at = IntegerField(default=lambda: int(time.time()))
+    create_at = IntegerField(default=lambda: int(time.time()), index=True)
 
 
 class Comment(Model):
@@ -51,9 +53,11 @@ class Comment(Model):
     Comment Model
     """
     __table__ = "t_comments"
+    # comments of a blog in order
+    __indexes__ = [("blog_id", "create_at")]
 
     id = StringField(primary_key=True, default=business_id)
     blog_id = StringField()
-    user_id = StringField()
+    user_id = StringField(index=True)
     content = TextField()
-    create_at = IntegerField(default=lambda: int(time.time()))
+    create_at = IntegerField(default=lambda: int(time.time()), index=True)
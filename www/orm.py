@@ -1,98 +1,624 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import itertools
 import logging
+import time
+from collections import namedtuple
 
-import aiomysql
+import backends
+import cache
+import metrics
+import tracing
+from cache import LRUCache
 
 __author__ = "Vic Yue"
 
 __pool = None
+# database backend of pools, cursors and placeholders
+_backend = backends.get("mysql")
+# read only replica pools, selects are routed to them
+__replicas = []
+__balance = "round_robin"
+__sticky = 0
+__round_robin = itertools.count()
+# time of last write in current request (task context), for read-your-writes stickiness
+_last_write = contextvars.ContextVar("orm_last_write", default=0.0)
+# pool name -> pool and pool -> name, for instrumentation
+_pools = {}
+_pool_names = {}
+# pool name -> coroutines waiting on acquire, and the peak since last adaptive check
+_waiting = collections.Counter()
+_waiting_peak = collections.Counter()
+__adaptive_task = None
+# callbacks of model writes, called with model class
+_write_listeners = []
+
+# max rows per multi-row statement of the bulk api
+BATCH_SIZE = 500
+# max cached statements of each statement cache
+STATEMENT_CACHE_SIZE = 1024
+# default options of count cache, models override by __count__ = dict(ttl=..., maxsize=...)
+COUNT_CACHE = dict(ttl=30, maxsize=1000)
+
+# result of Model.count, fresh is False when value is cached or approximate
+Count = namedtuple("Count", ["value", "fresh"])
 
 
 async def create_connection_pool(loop, **kw):
     """
     create global connection pool
     :param loop: default asyncio.get_event_loop()
-    :param kw: kwargs
+    :param kw: kwargs, backend: mysql or sqlite, sqlite takes path of database file;
+               replicas: list of replica kwargs, missing keys are taken from primary kwargs;
+               balance: replica balance, round_robin or least_busy;
+               sticky: seconds to read from primary after a write in the same request
     :return:
     """
     logging.info("Creating connection pool...")
+    global __pool, __replicas, __balance, __sticky, _backend
+    global __adaptive_task
+    _backend = backends.get(kw.get("backend", "mysql"))
+    _translate.cache_clear()
+    options = _backend.pool_options(kw)
+    # primary and read pools connect concurrently
+    pools = await asyncio.gather(*[_create_pool(loop, **o) for _, o in options])
+    __pool = pools[0]
+    _pools.clear()
+    _pool_names.clear()
+    for (name, _), pool in zip(options, pools):
+        _register_pool(name, pool)
+    __replicas = list(pools[1:])
+    __balance = kw.get("balance", "round_robin")
+    if __balance not in ("round_robin", "least_busy"):
+        raise ValueError("Invalid replica balance: %s" % __balance)
+    __sticky = kw.get("sticky", 0)
+    adaptive = kw.get("adaptive") or {}
+    if __adaptive_task is not None:
+        __adaptive_task.cancel()
+        __adaptive_task = None
+    if adaptive.get("enabled"):
+        __adaptive_task = asyncio.ensure_future(_adapt_pools(
+            adaptive.get("min", kw.get("maxsize", 10)), adaptive["max"], adaptive.get("interval", 5)))
+
+
+def backend():
+    """
+    :return: Backend of connection pools, see backends
+    """
+    return _backend
+
+
+async def close_connection_pool():
+    """
+    close primary and replica pools, waiting for connections in use to be released
+    """
+    global __pool, __replicas, __adaptive_task
+    if __adaptive_task is not None:
+        __adaptive_task.cancel()
+        __adaptive_task = None
+    for pool in [__pool] + __replicas:
+        if pool is not None:
+            pool.close()
+            await pool.wait_closed()
+    __pool = None
+    __replicas = []
+    _pools.clear()
+    _pool_names.clear()
+
+
+async def prefill_pools(size):
+    """
+    open connections of primary and replica pools up to size concurrently,
+    so first requests after startup don't pay for connection setup
+    :param size: connections of each pool, at most its maxsize
+    :return: dict of pool name -> connections
+    :raise ConnectionError: when a connection of any pool failed, after all pools were filled
+    """
+    async def fill(pool):
+        conns = await asyncio.gather(*[pool.acquire() for _ in range(min(size, pool.maxsize))],
+                                     return_exceptions=True)
+        errors = []
+        for conn in conns:
+            if isinstance(conn, BaseException):
+                errors.append(conn)
+            else:
+                await pool.release(conn)
+        if errors:
+            raise errors[0]
+        return pool.size
+
+    names = list(_pools)
+    sizes = await asyncio.gather(*[fill(_pools[name]) for name in names], return_exceptions=True)
+    for name, e in zip(names, sizes):
+        if isinstance(e, BaseException):
+            raise ConnectionError("Prefill of connection pool %s failed: %s" % (name, e)) from e
+    return dict(zip(names, sizes))
+
+
+async def _create_pool(loop, **kw):
+    return await _backend.create_pool(loop, **kw)
+
+
+def on_write(fn):
+    """
+    register callback called with model class after save, modify, remove and bulk writes of the model,
+    writes in a transaction call it after commit and not at all on rollback
+    :param fn: callback
+    :return: fn
+    """
+    _write_listeners.append(fn)
+    return fn
+
+
+def _register_pool(name, pool):
+    _pools[name] = pool
+    _pool_names[pool] = name
+
+
+ACQUIRE_SECONDS = metrics.Histogram("orm_pool_acquire_seconds", "Time waiting for a pool connection.", ("pool",))
+HOLD_SECONDS = metrics.Histogram("orm_pool_hold_seconds", "Time a pool connection is held.", ("pool",))
+QUERY_SECONDS = metrics.Histogram("orm_query_seconds", "Statement latency.", ("pool", "kind"))
+
+
+class DBTime(object):
+    """
+    Statements time and count of a request
+    """
+    __slots__ = ("seconds", "queries")
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+
+_db_time = contextvars.ContextVar("orm_db_time", default=None)
+
+
+def track_db_time():
+    """
+    start tracking statements time of current context (request task)
+    :return: DBTime
+    """
+    db = DBTime()
+    _db_time.set(db)
+    return db
+
+
+def _observe_query(elapsed, pool_name, kind, sql):
+    QUERY_SECONDS.observe(elapsed, pool_name, kind)
+    tracing.record("sql", elapsed, sql)
+    db = _db_time.get()
+    if db is not None:
+        db.seconds += elapsed
+        db.queries += 1
+
+
+def pool_stats():
+    """
+    connection pool usage
+    :return: dict of pool name -> stats
+    """
+    ret = {}
+    for name, pool in _pools.items():
+        ret[name] = dict(size=pool.size, free=pool.freesize, in_use=pool.size - pool.freesize,
+                         minsize=pool.minsize, maxsize=pool.maxsize, waiting=_waiting[name],
+                         acquire=ACQUIRE_SECONDS.snapshot(name), hold=HOLD_SECONDS.snapshot(name))
+    return ret
+
+
+def _collect_pool_gauges():
+    for name, stats in pool_stats().items():
+        for state in ("size", "free", "in_use", "maxsize", "waiting"):
+            yield (name, state), stats[state]
+
+
+def _collect_cache_gauges():
+    for name, stats in cache.stats().items():
+        for k in ("hits", "misses", "evictions", "size"):
+            yield (name, k), stats[k]
+
+
+metrics.Gauge("orm_pool_connections", "Pool connections by state.", ("pool", "state"), collect=_collect_pool_gauges)
+metrics.Gauge("orm_find_cache", "Model find cache counters.", ("cache", "stat"), collect=_collect_cache_gauges)
+
+
+@contextlib.asynccontextmanager
+async def _acquire(pool):
+    """
+    acquire connection from pool, recording wait and hold time
+    :param pool: pool
+    :return: async context manager of connection
+    """
+    name = _pool_names.get(pool, "primary")
+    start = time.monotonic()
+    _waiting[name] += 1
+    _waiting_peak[name] = max(_waiting_peak[name], _waiting[name])
+    try:
+        conn = await pool.acquire()
+    finally:
+        _waiting[name] -= 1
+    acquired = time.monotonic()
+    ACQUIRE_SECONDS.observe(acquired - start, name)
+    tracing.record("acquire", acquired - start, name)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+        HOLD_SECONDS.observe(time.monotonic() - acquired, name)
+
+
+def _resize_pool(pool, maxsize):
+    """
+    change pool maxsize, free connections over new size are closed.
+    aiomysql keeps maxsize as the bound of its free connection deque, it is never below in use connections.
+    """
+    maxsize = max(maxsize, pool.size - pool.freesize, pool.minsize, 1)
+    free = pool._free
+    while free and pool.size > maxsize:
+        free.pop().close()
+    pool._free = collections.deque(free, maxlen=maxsize)
+
+
+async def _adapt_pools(lower, upper, interval):
+    """
+    grow pools when coroutines queued on acquire, shrink them when idle connections are left
+    :param lower: min maxsize
+    :param upper: max maxsize
+    :param interval: check interval seconds
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for name, pool in list(_pools.items()):
+            peak, _waiting_peak[name] = _waiting_peak[name], _waiting[name]
+            target = pool.maxsize
+            if peak > 0:
+                target = min(upper, pool.maxsize + peak)
+            elif pool.freesize > 1:
+                target = max(lower, pool.maxsize - 1)
+            if target != pool.maxsize:
+                logging.info("Resize connection pool %s: %s -> %s (queue peak %s)" % (name, pool.maxsize, target, peak))
+                _resize_pool(pool, target)
+
+
+def _read_pool():
+    """
+    choose pool for read, primary is used when no replica or a write happened within sticky window
+    :return: pool
+    """
     global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get("host", "localhost"),
-        port=kw.get("port", 3306),
-        user=kw["user"],
-        password=kw["password"],
-        db=kw["db"],
-        charset=kw.get("charset", "utf8"),
-        autocommit=kw.get("autocommit", True),
-        maxsize=kw.get("maxsize", 10),
-        minsize=kw.get("minsize", 1),
-        loop=loop
-    )
-
-
-async def select(sql, args, size=None):
+    if not __replicas:
+        return __pool
+    if __sticky and time.monotonic() - _last_write.get() < __sticky:
+        return __pool
+    if __balance == "least_busy":
+        return min(__replicas, key=lambda p: p.size - p.freesize)
+    return __replicas[next(__round_robin) % len(__replicas)]
+
+
+def _mark_write():
+    if __sticky:
+        _last_write.set(time.monotonic())
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _translate(sql):
+    """
+    translate `?` placeholder to the backend driver's placeholder, cached by sql string
+    :param sql: sql statement with `?` placeholder
+    :return: driver sql statement
+    """
+    return _backend.translate(sql)
+
+
+def statement_cache_info():
+    """
+    statement caches usage
+    :return: dict of cache name -> functools cache info
+    """
+    return dict(translate=_translate.cache_info(), find_all=_find_all_sql.cache_info(),
+                count=_count_sql.cache_info(), query=_query_sql.cache_info())
+
+
+class Transaction(object):
+    """
+    Transaction bound to one connection, statements of the transaction are serialized by lock.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        self.savepoints = 0
+        self._callbacks = []
+        self._commit_callbacks = []
+
+    def after_exit(self, fn):
+        """
+        call fn when outermost transaction exits, whether committed or rolled back
+        """
+        self._callbacks.append(fn)
+
+    def after_commit(self, fn):
+        """
+        call fn after outermost transaction committed, not called on rollback
+        """
+        self._commit_callbacks.append(fn)
+
+    async def _run(self, sql):
+        async with self.lock:
+            async with self.conn.cursor() as cur:
+                await cur.execute(sql)
+
+
+_transaction = contextvars.ContextVar("orm_transaction", default=None)
+
+
+def current_transaction():
+    """
+    :return: transaction of current context or None
+    """
+    return _transaction.get()
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    """
+    async with transaction() as tx: statements of orm and Model methods inside the block reuse one connection,
+    committed on exit and rolled back on exception. Nested blocks use savepoints.
+    :return: async context manager of Transaction
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        tx.savepoints += 1
+        savepoint = "sp_%s" % tx.savepoints
+        await tx._run("SAVEPOINT %s" % savepoint)
+        try:
+            yield tx
+        except BaseException:
+            await tx._run("ROLLBACK TO SAVEPOINT %s" % savepoint)
+            raise
+        await tx._run("RELEASE SAVEPOINT %s" % savepoint)
+        return
+    global __pool
+    assert __pool is not None
+    async with _acquire(__pool) as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+        finally:
+            _transaction.reset(token)
+            for fn in tx._callbacks:
+                fn()
+        for fn in tx._commit_callbacks:
+            fn()
+
+
+@contextlib.asynccontextmanager
+async def _connection(pool):
+    """
+    connection of current transaction, or acquired from pool
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        async with tx.lock:
+            yield tx.conn
+    else:
+        async with _acquire(pool) as conn:
+            yield conn
+
+
+async def select(sql, args, size=None, primary=False, tuples=False):
     """
     select common method
     :param sql: select sql statement
     :param args: sql args
     :param size: fetch size, default all return
+    :param primary: read from primary instead of replicas, always true in transaction
+    :param tuples: return rows as tuples instead of dict
     :return: result dict
     """
-    logging.info(sql, args)
+    logging.debug("SQL: %s, args: %s", sql, args)
     global __pool
-    assert isinstance(__pool, aiomysql.Pool)
-    async with __pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace("?", "%s"), args or ())
+    pool = __pool if primary or _transaction.get() else _read_pool()
+    assert pool is not None
+    async with _connection(pool) as conn:
+        async with conn.cursor(_backend.tuple_cursor if tuples else _backend.dict_cursor) as cur:
+            start = time.monotonic()
+            await cur.execute(_translate(sql), args or ())
             if size and isinstance(size, int) and size > 0:
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-            logging.info("select return size:%s" % len(rs))
+            _observe_query(time.monotonic() - start, _pool_names.get(pool, "primary"), "select", sql)
+            logging.debug("select return size: %s", len(rs))
             return rs
 
 
+async def select_iter(sql, args, batch_size=1000, primary=False, tuples=False):
+    """
+    select with server side cursor, rows are streamed from server in batches.
+    In transaction the result is buffered, so other statements can run on the connection while iterating.
+    :param sql: select sql statement
+    :param args: sql args
+    :param batch_size: fetch size of each batch
+    :param primary: read from primary instead of replicas
+    :param tuples: return rows as tuples instead of dict
+    :return: async generator of result dict list
+    """
+    if _transaction.get() is not None:
+        rs = await select(sql, args, tuples=tuples)
+        for i in range(0, len(rs), batch_size):
+            yield rs[i:i + batch_size]
+        return
+    logging.debug("SQL: %s, args: %s", sql, args)
+    global __pool
+    pool = __pool if primary else _read_pool()
+    assert pool is not None
+    async with _acquire(pool) as conn:
+        async with conn.cursor(_backend.stream_tuple_cursor if tuples else _backend.stream_cursor) as cur:
+            await cur.execute(_translate(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                yield rs
+
+
 async def execute(sql, args, autocommit=True):
     """
     execute common method
     :param sql: insert, update, delete statement
     :param args: sql args
-    :param autocommit: whether autocommit
+    :param autocommit: whether autocommit, False runs the statement in its own transaction (savepoint if nested)
     :return:
     """
-    logging.info(sql, args)
+    if not autocommit:
+        async with transaction():
+            return await execute(sql, args)
+    logging.debug("SQL: %s, args: %s", sql, args)
     global __pool
-    assert isinstance(__pool, aiomysql.Pool)
-    async with __pool.acquire() as conn:
-        if not autocommit:
-            await conn.begin()
-        try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace("?", "%s"), args or ())
-                affected = cur.rowcount
-                if not autocommit:
-                    await conn.commit()
-        except BaseException:
-            if not autocommit:
-                await conn.rollback()
-            raise
+    assert __pool is not None
+    _mark_write()
+    async with _connection(__pool) as conn:
+        async with conn.cursor(_backend.dict_cursor) as cur:
+            start = time.monotonic()
+            await cur.execute(_translate(sql), args or ())
+            _observe_query(time.monotonic() - start, "primary", "execute", sql)
+            return cur.rowcount
+
+
+async def execute_batch(statements):
+    """
+    execute statements in one transaction on one connection
+    :param statements: list of (sql, args, many) tuple, when many is True args is a list of args
+    :return: affected rows of each statement
+    """
+    _mark_write()
+    async with transaction() as tx:
+        affected = []
+        for sql, args, many in statements:
+            logging.debug("SQL: %s, many: %s", sql, many)
+            async with tx.lock:
+                async with tx.conn.cursor() as cur:
+                    start = time.monotonic()
+                    if many:
+                        await cur.executemany(_translate(sql), args)
+                    else:
+                        await cur.execute(_translate(sql), args or ())
+                    _observe_query(time.monotonic() - start, "primary", "execute", sql)
+                    affected.append(cur.rowcount)
         return affected
 
 
+def _chunked(seq, size):
+    """
+    split sequence to chunks
+    :param seq: list or tuple
+    :param size: chunk size
+    :return: generator of chunks
+    """
+    if not isinstance(size, int) or size <= 0:
+        raise ValueError("Invalid chunk size: %s" % size)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _limit_args(limit, args):
+    """
+    append limit arguments to args
+    :param limit: int or (offset, count)
+    :param args: sql args
+    :return: limit form of _find_all_sql
+    """
+    if not limit:
+        return None
+    if isinstance(limit, int):
+        args.append(limit)
+        return 1
+    if isinstance(limit, (tuple, list)) and len(limit) == 2:
+        args.extend(limit)
+        return 2
+    error_msg = "Invalid limit arguments: %s" % limit
+    logging.warning(error_msg)
+    raise ValueError(error_msg)
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _find_all_sql(model, where, order_by, limit_form, columns=None):
+    """
+    compile find_all statement, cached by query shape
+    :param model: model class
+    :param where: where clause
+    :param order_by: order by clause
+    :param limit_form: None, 1 for `LIMIT ?`, 2 for `LIMIT ?, ?`
+    :param columns: tuple of selected attribute names, default all columns
+    :return: sql statement
+    """
+    if columns is None:
+        sql = [model.__select__]
+    else:
+        sql = ["SELECT %s FROM %s" % (", ".join(["`%s`" % model.__mappings__[c].name for c in columns]),
+                                      model.__table__)]
+    if where and isinstance(where, str):
+        sql.append("WHERE")
+        sql.append(where)
+    if order_by and isinstance(order_by, str):
+        sql.append("ORDER BY")
+        sql.append(order_by)
+    if limit_form == 1:
+        sql.append("LIMIT ?")
+    elif limit_form == 2:
+        sql.append("LIMIT ?, ?")
+    return _precompile(" ".join(sql))
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _count_sql(model, where):
+    """
+    compile get_count statement, cached by query shape
+    """
+    sql = ["SELECT COUNT(1) _num_ FROM `%s`" % model.__table__]
+    if where and isinstance(where, str):
+        sql.append("WHERE")
+        sql.append(where)
+    return _precompile(" ".join(sql))
+
+
+def _precompile(sql):
+    """
+    translate statement ahead, keeping placeholder translation off the request path
+    """
+    _translate(sql)
+    return sql
+
+
 class Field(object):
     """
     orm field class type
     """
 
-    def __init__(self, name, column_type, primary_key, default, nullable):
+    def __init__(self, name, column_type, primary_key, default, nullable, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self._default = default
         self.nullable = nullable
+        # single column secondary index, unique implies index
+        self.index = index or unique
+        self.unique = unique
 
     @property
     def default(self):
@@ -109,8 +635,8 @@ class IntegerField(Field):
     orm integer field type
     """
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, "bigint", primary_key, default, False)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, "bigint", primary_key, default, False, index, unique)
 
 
 class StringField(Field):
@@ -118,8 +644,8 @@ class StringField(Field):
     orm string field type
     """
 
-    def __init__(self, name=None, primary_key=False, default=None, ddl="varchar(32)"):
-        super().__init__(name, ddl, primary_key, default, False)
+    def __init__(self, name=None, primary_key=False, default=None, ddl="varchar(32)", index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, False, index, unique)
 
 
 class BooleanField(Field):
@@ -127,8 +653,8 @@ class BooleanField(Field):
     orm boolean field type
     """
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, "boolean", False, default, False)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, "boolean", False, default, False, index)
 
 
 class FloatField(Field):
@@ -136,8 +662,8 @@ class FloatField(Field):
     orm float field type
     """
 
-    def __init__(self, name=None, default=0.0):
-        super().__init__(name, "real", False, default, False)
+    def __init__(self, name=None, default=0.0, index=False, unique=False):
+        super().__init__(name, "real", False, default, False, index, unique)
 
 
 class TextField(Field):
@@ -149,14 +675,88 @@ class TextField(Field):
         super().__init__(name, "text", False, default, False)
 
 
-def _gen_sql(table_name, mappings, rebuild=True):
+class Index(object):
+    """
+    Secondary index of model columns, declared by __indexes__ = [("blog_id", "create_at"), Index("email", unique=True)]
+    """
+
+    def __init__(self, *columns, unique=False, name=None):
+        if not columns:
+            raise ValueError("Index requires columns")
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.name = name
+
+    def key(self):
+        """
+        identity of index regardless of its name
+        """
+        return self.columns, self.unique
+
+    def __eq__(self, other):
+        return isinstance(other, Index) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "Index(%s%s)" % (", ".join(repr(c) for c in self.columns), ", unique=True" if self.unique else "")
+
+
+# max length of index name of mysql
+INDEX_NAME_SIZE = 64
+
+
+def _index_name(table_name, index):
+    if index.name:
+        return index.name
+    name = "%s_%s_%s" % ("uk" if index.unique else "idx", table_name, "_".join(index.columns))
+    if len(name) > INDEX_NAME_SIZE:
+        name = "%s_%s" % (name[:INDEX_NAME_SIZE - 9], hashlib.sha1(name.encode()).hexdigest()[:8])
+    return name
+
+
+def _model_indexes(table_name, mappings, declared):
+    """
+    indexes of index/unique fields and __indexes__ entries, attribute names are mapped to column names
+    :return: tuple of named Index
+    """
+    indexes = []
+    for k, v in mappings.items():
+        if v.index and not v.primary_key:
+            indexes.append(Index(v.name, unique=v.unique))
+    for entry in declared or ():
+        if isinstance(entry, str):
+            entry = Index(entry)
+        elif not isinstance(entry, Index):
+            entry = Index(*entry)
+        for c in entry.columns:
+            if c not in mappings:
+                raise ValueError("Unknown index column of %s: %s" % (table_name, c))
+        indexes.append(Index(*[mappings[c].name for c in entry.columns], unique=entry.unique, name=entry.name))
+    ret = []
+    for index in indexes:
+        if index not in ret:
+            ret.append(Index(*index.columns, unique=index.unique, name=_index_name(table_name, index)))
+    return tuple(ret)
+
+
+def _create_index_sql(table_name, index):
+    return "CREATE %sINDEX `%s` ON `%s` (%s);" % ("UNIQUE " if index.unique else "", index.name, table_name,
+                                                ", ".join("`%s`" % c for c in index.columns))
+
+
+def _gen_sql(table_name, mappings, rebuild=True, indexes=()):
     """
-    generate create table ddl
+    generate create table ddl, with secondary indexes as CREATE INDEX statements that mysql and sqlite both accept
     :param table_name:
     :param mappings:
+    :param rebuild: drop table first
+    :param indexes: named indexes of _model_indexes
     :return:
     """
     assert isinstance(table_name, str) and isinstance(mappings, dict)
+    sql = []
     if rebuild:
         sql = ["-- DROP EXISTS TABLE: %s" % table_name, "DROP TABLE IF EXISTS `%s`;" % table_name]
     pk = None
@@ -170,9 +770,73 @@ def _gen_sql(table_name, mappings, rebuild=True):
         sql.append("  `%s` %s %s," % (v.name, v.column_type, " ".join(ddl)))
     sql.append("  PRIMARY KEY(`%s`)" % pk)
     sql.append(");")
+    for index in indexes:
+        sql.append(_create_index_sql(table_name, index))
     return "\n".join(sql)
 
 
+class Row(object):
+    """
+    Read only row of selected columns, row classes are generated per model and columns by _row_class
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for k, v in zip(self.__slots__, values):
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("'%s' is read only" % self.__class__.__name__)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.values() == other.values()
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % (k, getattr(self, k)) for k in self.__slots__))
+
+    def keys(self):
+        return self.__slots__
+
+    def values(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def items(self):
+        return zip(self.__slots__, self.values())
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _row_class(model, columns):
+    """
+    generate read only row class of model's columns
+    :param model: model class
+    :param columns: tuple of attribute names
+    :return: Row subclass
+    """
+    cls = type("%sRow" % model.__name__, (Row,), dict(__slots__=columns, __module__=model.__module__))
+    # unrolled __init__ storing values by the slot descriptors, several times faster than a loop of setattr
+    args = ", ".join("_%s" % i for i in range(len(columns)))
+    namespace = {"_set%s" % i: cls.__dict__[c].__set__ for i, c in enumerate(columns)}
+    exec("def __init__(self, %s):\n%s" % (args, "".join("    _set%s(self, _%s)\n" % (i, i)
+                                                         for i in range(len(columns)))), namespace)
+    cls.__init__ = namespace["__init__"]
+    return cls
+
+
 class ModelMetaclass(type):
     def __new__(mcs, name, bases, attrs):
         if name == "Model":
@@ -203,18 +867,30 @@ class ModelMetaclass(type):
         attrs["__table__"] = table_name
         attrs["__primary_key__"] = primary_key
         attrs["__fields__"] = fields
-        # insert sql
-        attrs["__insert__"] = "INSERT INTO %s(%s, `%s`) VALUES (%s)" % (
-            table_name, escaped_fields, primary_key,
-            ", ".join(["?" for _ in range(len(fields) + 1)]))
+        # insert sql, head and row placeholder are reused by multi-row insert
+        attrs["__insert_head__"] = "INSERT INTO %s(%s, `%s`) VALUES " % (table_name, escaped_fields, primary_key)
+        attrs["__insert_row__"] = "(%s)" % ", ".join(["?" for _ in range(len(fields) + 1)])
+        attrs["__insert__"] = attrs["__insert_head__"] + attrs["__insert_row__"]
         # update sql
         attrs["__update__"] = "UPDATE %s SET %s WHERE %s" % (
             table_name, ", ".join(["`%s`=?" % mappings.get(f).name or f for f in fields]), "`%s`=?" % primary_key)
         # delete sql
         attrs["__delete__"] = "DELETE FROM %s WHERE %s" % (table_name, "`%s`=?" % primary_key)
+        attrs["__delete_in__"] = "DELETE FROM %s WHERE `%s` IN " % (table_name, primary_key)
         # select sql
         attrs["__select__"] = "SELECT `%s`, %s FROM %s" % (primary_key, escaped_fields, table_name)
-        attrs["__ddl_sql__"] = lambda: _gen_sql(table_name, mappings)
+        attrs["__select_pk__"] = "%s WHERE `%s`=?" % (attrs["__select__"], primary_key)
+        for k in ("__insert__", "__update__", "__delete__", "__select_pk__"):
+            _precompile(attrs[k])
+        # secondary indexes of index/unique fields and __indexes__ = [("blog_id", "create_at"), ...]
+        indexes = _model_indexes(table_name, mappings, attrs.get("__indexes__", None))
+        attrs["__indexes__"] = indexes
+        attrs["__ddl_sql__"] = lambda: _gen_sql(table_name, mappings, indexes=indexes)
+        # find by primary key cache, enabled by __cache__ = dict(ttl=60, maxsize=10000)
+        cache_options = attrs.get("__cache__", None)
+        attrs["__find_cache__"] = LRUCache(name=table_name, **cache_options) if cache_options else None
+        attrs["__count_cache__"] = LRUCache(name="count:%s" % table_name,
+                                            **(attrs.get("__count__", None) or COUNT_CACHE))
         return type.__new__(mcs, name, bases, attrs)
 
 
@@ -241,7 +917,7 @@ class Model(dict, metaclass=ModelMetaclass):
             default = field.default
             if default is not None:
                 value = default
-                logging.info("using default value for %s: %s" % (key, value))
+                logging.debug("using default value for %s: %s", key, value)
                 setattr(self, key, value)
         return value
 
@@ -250,15 +926,157 @@ class Model(dict, metaclass=ModelMetaclass):
         """
         find object by primary key's value
         :param pk: primary key's value
-        :return:
+        :return: object, a copy of the cached one when the model has a find cache
         """
+        if not pk:
+            return None
+        cache = cls.__find_cache__
+        if cache is not None:
+            obj = await cache.get_or_load(pk, lambda: cls._load(pk))
+            # cached objects are shared by all requests, callers may change theirs
+            return cls(**obj) if obj is not None else None
+        return await cls._load(pk)
+
+    @classmethod
+    async def _load(cls, pk):
         ret = None
-        if pk:
-            rs = await select("%s WHERE `%s`=?" % (cls.__select__, cls.__primary_key__), [pk], 1)
-            if len(rs) == 1:
-                ret = cls(**rs[0])
+        rs = await select(cls.__select_pk__, [pk], 1)
+        if len(rs) == 1:
+            ret = cls(**rs[0])
         return ret
 
+    @classmethod
+    async def prime_cache(cls, where=None, args=None, order_by=None, limit=1000):
+        """
+        load objects into find cache, e.g. hot rows at startup
+        :param where: where clause
+        :param args: where args
+        :param order_by: order by clause
+        :param limit: max objects
+        :return: number of cached objects, 0 when model has no cache
+        """
+        cache = cls.__find_cache__
+        if cache is None:
+            return 0
+        objs = await cls.find_all(where, args, order_by, limit)
+        for obj in objs:
+            cache.set(obj[cls.__primary_key__], obj)
+        return len(objs)
+
+    @classmethod
+    async def find_many(cls, pks, chunk_size=BATCH_SIZE):
+        """
+        find objects by primary key's values with chunked `IN` queries
+        :param pks: primary key's values
+        :param chunk_size: max primary keys per query
+        :return: objects in input order, None for not found
+        """
+        pks = list(pks)
+        found = {}
+        cache = cls.__find_cache__
+        missing = []
+        for pk in dict.fromkeys(pks):
+            if not pk:
+                continue
+            obj = cache.get(pk) if cache is not None else None
+            if obj is None:
+                missing.append(pk)
+            else:
+                found[pk] = cls(**obj)
+        pk_name = cls.__primary_key__
+        for chunk in _chunked(missing, chunk_size):
+            sql = "%s WHERE `%s` IN (%s)" % (cls.__select__, pk_name, ", ".join(["?"] * len(chunk)))
+            for r in await select(sql, list(chunk)):
+                obj = cls(**r)
+                found[obj[pk_name]] = obj
+                if cache is not None:
+                    cache.set(obj[pk_name], cls(**obj))
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    async def count(cls, where=None, args=None, mode="exact"):
+        """
+        count objects for pagination
+        :param where: where clause
+        :param args: where args
+        :param mode: exact runs COUNT; cached reuses a count cached within ttl, adjusted on save/remove;
+                     approx uses table statistics (information_schema of mysql) for unfiltered count,
+                     falls back to cached with where clause
+        :return: Count(value, fresh)
+        """
+        if mode == "approx" and not where and _backend.approx_count_sql is not None:
+            rs = await select(_backend.approx_count_sql, [cls.__table__], 1)
+            if rs and rs[0]["_num_"] is not None:
+                return Count(rs[0]["_num_"], False)
+            mode = "cached"
+        if mode == "exact":
+            return Count(await cls.get_count(where, args) or 0, True)
+        if mode not in ("cached", "approx"):
+            raise ValueError("Invalid count mode: %s" % mode)
+        key = (where or None, tuple(args or ()))
+        loaded = []
+
+        async def load():
+            loaded.append(True)
+            return await cls.get_count(where, args)
+
+        value = await cls.__count_cache__.get_or_load(key, load)
+        return Count(value or 0, bool(loaded))
+
+    @classmethod
+    def _count_changed(cls, delta):
+        """
+        adjust cached unfiltered count by delta, filtered counts are dropped
+        """
+        cache = cls.__count_cache__
+        if _transaction.get() is not None:
+            # the transaction may roll back, recount after it ends
+            cache.clear()
+            _transaction.get().after_exit(cache.clear)
+            return
+        for key in cache.keys():
+            if key[0] is None and delta:
+                cache.update(key, lambda n: n + delta)
+            else:
+                cache.invalidate(key)
+
+    @classmethod
+    def query(cls):
+        """
+        create a lazy chainable query, e.g. Blog.query().filter(user_id=uid).order_by("-create_at").limit(20)
+        :return: Query
+        """
+        return Query(cls)
+
+    @classmethod
+    def loader(cls):
+        """
+        create a request scoped batch loader of this model
+        :return: ModelLoader
+        """
+        return ModelLoader(cls)
+
+    @classmethod
+    def _notify_write(cls):
+        for fn in _write_listeners:
+            fn(cls)
+
+    @classmethod
+    def _invalidate(cls, *pks):
+        tx = _transaction.get()
+        if tx is None:
+            cls._notify_write()
+        else:
+            # concurrent requests would cache what they read before commit, listeners run once it committed
+            tx.after_commit(cls._notify_write)
+        cache = cls.__find_cache__
+        if cache is not None:
+            for pk in pks:
+                cache.invalidate(pk)
+            if tx is not None:
+                # concurrent readers may cache the old row until the transaction ends
+                tx.after_exit(lambda: [cache.invalidate(pk) for pk in pks])
+
     async def save(self):
         """
         save object
@@ -267,6 +1085,8 @@ class Model(dict, metaclass=ModelMetaclass):
         args = [self.get_value_or_default(f) for f in self.__fields__]
         args.append(self.get_value_or_default(self.__primary_key__))
         rows = await execute(self.__insert__, args)
+        self._invalidate(args[-1])
+        self._count_changed(rows)
         if rows != 1:
             logging.warning("failed to insert record: affected rows: %s" % rows)
 
@@ -278,6 +1098,8 @@ class Model(dict, metaclass=ModelMetaclass):
         args = [self.get_value(f) for f in self.__fields__]
         args.append(self.get_value(self.__primary_key__))
         rows = await execute(self.__update__, args)
+        self._invalidate(args[-1])
+        self._count_changed(0)
         if rows != 1:
             logging.warning("failed to update by primary key: affected rows: %s" % rows)
 
@@ -288,43 +1110,418 @@ class Model(dict, metaclass=ModelMetaclass):
         """
         args = [self.get_value(self.__primary_key__)]
         rows = await execute(self.__delete__, args)
+        self._invalidate(args[0])
+        self._count_changed(-rows)
         if rows != 1:
             logging.warning("failed to delete by primary key: affected rows: %s" % rows)
 
     @classmethod
-    async def find_all(cls, where=None, args=None, order_by=None, limit=None):
-        sql = [cls.__select__]
-        if where and isinstance(where, str):
-            sql.append("WHERE")
-            sql.append(where)
+    async def save_many(cls, objs, chunk_size=BATCH_SIZE):
+        """
+        save objects with multi-row insert statements in one transaction
+        :param objs: list of objects
+        :param chunk_size: max rows per statement
+        :return: affected rows of each chunk
+        """
+        objs = list(objs)
+        if not objs:
+            return []
+        statements = []
+        for chunk in _chunked(objs, chunk_size):
+            args = []
+            for obj in chunk:
+                args.extend([obj.get_value_or_default(f) for f in cls.__fields__])
+                args.append(obj.get_value_or_default(cls.__primary_key__))
+            sql = cls.__insert_head__ + ", ".join([cls.__insert_row__] * len(chunk))
+            statements.append((sql, args, False))
+        counts = await execute_batch(statements)
+        cls._invalidate(*[obj.get_value(cls.__primary_key__) for obj in objs])
+        cls._count_changed(sum(counts))
+        if sum(counts) != len(objs):
+            logging.warning("failed to insert records: affected rows: %s of %s" % (sum(counts), len(objs)))
+        return counts
+
+    @classmethod
+    async def modify_many(cls, objs, chunk_size=BATCH_SIZE):
+        """
+        update objects by primary key with executemany in one transaction
+        :param objs: list of objects
+        :param chunk_size: max rows per executemany
+        :return: affected rows of each chunk
+        """
+        objs = list(objs)
+        if not objs:
+            return []
+        statements = []
+        for chunk in _chunked(objs, chunk_size):
+            args = []
+            for obj in chunk:
+                row = [obj.get_value(f) for f in cls.__fields__]
+                row.append(obj.get_value(cls.__primary_key__))
+                args.append(row)
+            statements.append((cls.__update__, args, True))
+        counts = await execute_batch(statements)
+        cls._invalidate(*[obj.get_value(cls.__primary_key__) for obj in objs])
+        cls._count_changed(0)
+        if sum(counts) != len(objs):
+            logging.warning("failed to update by primary key: affected rows: %s of %s" % (sum(counts), len(objs)))
+        return counts
+
+    @classmethod
+    async def remove_many(cls, objs, chunk_size=BATCH_SIZE):
+        """
+        delete objects by primary key with `IN` statements in one transaction
+        :param objs: list of objects
+        :param chunk_size: max primary keys per statement
+        :return: affected rows of each chunk
+        """
+        pks = [obj.get_value(cls.__primary_key__) for obj in objs]
+        if not pks:
+            return []
+        statements = []
+        for chunk in _chunked(pks, chunk_size):
+            sql = "%s(%s)" % (cls.__delete_in__, ", ".join(["?"] * len(chunk)))
+            statements.append((sql, list(chunk), False))
+        counts = await execute_batch(statements)
+        cls._invalidate(*pks)
+        cls._count_changed(-sum(counts))
+        if sum(counts) != len(pks):
+            logging.warning("failed to delete by primary key: affected rows: %s of %s" % (sum(counts), len(pks)))
+        return counts
+
+    @classmethod
+    async def find_all(cls, where=None, args=None, order_by=None, limit=None, as_rows=False):
+        """
+        find objects
+        :param where: where clause
+        :param args: where args
+        :param order_by: order by clause
+        :param limit: int or (offset, count)
+        :param as_rows: return read only rows instead of objects, see select_columns
+        :return: list of objects
+        """
+        if as_rows:
+            return await cls.select_columns(where=where, args=args, order_by=order_by, limit=limit)
+        args = [] if args is None else list(args)
+        limit_form = _limit_args(limit, args)
+        rs = await select(_find_all_sql(cls, where, order_by, limit_form), args)
+        return [cls(**r) for r in rs]
+
+    @classmethod
+    async def select_columns(cls, columns=None, where=None, args=None, order_by=None, limit=None, as_tuples=False):
+        """
+        find read only rows of selected columns, much cheaper than objects for large results
+        :param columns: attribute names, default all columns
+        :param where: where clause
+        :param args: where args
+        :param order_by: order by clause
+        :param limit: int or (offset, count)
+        :param as_tuples: return plain tuples in columns order
+        :return: list of rows with __slots__ attributes, or tuples
+        """
+        columns = tuple(columns) if columns else (cls.__primary_key__,) + tuple(cls.__fields__)
+        for c in columns:
+            if c not in cls.__mappings__:
+                raise ValueError("Unknown column of %s: %s" % (cls.__name__, c))
+        args = [] if args is None else list(args)
+        limit_form = _limit_args(limit, args)
+        rs = await select(_find_all_sql(cls, where, order_by, limit_form, columns), args, tuples=True)
+        if as_tuples:
+            return rs
+        row_class = _row_class(cls, columns)
+        return [row_class(*r) for r in rs]
+
+    @classmethod
+    async def iter_all(cls, where=None, args=None, order_by=None, batch_size=1000, keyset=False):
+        """
+        iterate objects in batches without loading whole result
+        :param where: where clause
+        :param args: where args
+        :param order_by: order by clause, not allowed in keyset mode
+        :param batch_size: objects per batch
+        :param keyset: page by primary key instead of streaming one server side cursor,
+                       connection is only held while fetching each batch
+        :return: async generator of object list
+        """
         if args is None:
             args = []
         assert isinstance(args, list)
-        if order_by and isinstance(order_by, str):
-            sql.append("ORDER BY")
-            sql.append(order_by)
-        if limit:
-            sql.append("LIMIT")
-            if isinstance(limit, int):
-                sql.append("?")
-                args.append(limit)
-            elif isinstance(limit, (tuple, list)) and len(limit) == 2:
-                sql.append("?, ?")
-                args.extend(limit)
-            else:
-                error_msg = "Invalid limit arguments: %s" % limit
-                logging.warning(error_msg)
-                raise ValueError(error_msg)
-        rs = await select(" ".join(sql), args)
-        return [cls(**r) for r in rs]
+        if not keyset:
+            async for rs in select_iter(_find_all_sql(cls, where, order_by, None), args, batch_size):
+                yield [cls(**r) for r in rs]
+            return
+        if order_by:
+            raise ValueError("order_by is not supported in keyset mode, objects are ordered by primary key")
+        pk = cls.__primary_key__
+        conditions = ["(%s)" % where] if where and isinstance(where, str) else []
+        last = None
+        while True:
+            cond, params = conditions, args
+            if last is not None:
+                cond, params = conditions + ["`%s`>?" % pk], args + [last]
+            sql = [cls.__select__]
+            if cond:
+                sql.append("WHERE")
+                sql.append(" AND ".join(cond))
+            sql.append("ORDER BY `%s` LIMIT ?" % pk)
+            rs = await select(" ".join(sql), params + [batch_size])
+            if not rs:
+                break
+            yield [cls(**r) for r in rs]
+            if len(rs) < batch_size:
+                break
+            last = rs[-1][pk]
 
     @classmethod
     async def get_count(cls, where=None, args=None):
-        sql = ["SELECT COUNT(1) _num_ FROM `%s`" % cls.__table__]
-        if where and isinstance(where, str):
-            sql.append("WHERE")
-            sql.append(where)
-        rs = await select(" ".join(sql), args)
+        rs = await select(_count_sql(cls, where), args)
         if len(rs) == 0:
             return None
         return rs[0]["_num_"]
+
+
+_FILTER_OPERATORS = {"eq": "=", "ne": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<=", "in": "IN"}
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def _query_sql(model, kind, filters, wheres, order, limit_form, columns):
+    """
+    compile query statement, cached by query shape
+    :param model: model class
+    :param kind: select, count or exists
+    :param filters: tuple of (attribute name, operator, placeholders count)
+    :param wheres: tuple of raw where clauses
+    :param order: tuple of (attribute name, descending)
+    :param limit_form: None, 1 for `LIMIT ?`, 2 for `LIMIT ?, ?`
+    :param columns: tuple of selected attribute names or None
+    :return: sql statement
+    """
+    mappings = model.__mappings__
+    if kind == "count":
+        sql = ["SELECT COUNT(1) _num_ FROM `%s`" % model.__table__]
+    elif kind == "exists":
+        sql = ["SELECT 1 FROM `%s`" % model.__table__]
+    elif columns is None:
+        sql = [model.__select__]
+    else:
+        sql = ["SELECT %s FROM %s" % (", ".join(["`%s`" % mappings[c].name for c in columns]), model.__table__)]
+    conditions = []
+    for name, op, n in filters:
+        if op == "in":
+            conditions.append("`%s` IN (%s)" % (mappings[name].name, ", ".join(["?"] * n)))
+        else:
+            conditions.append("`%s`%s?" % (mappings[name].name, _FILTER_OPERATORS[op]))
+    conditions.extend(["(%s)" % w for w in wheres])
+    if conditions:
+        sql.append("WHERE")
+        sql.append(" AND ".join(conditions))
+    if kind == "select" and order:
+        sql.append("ORDER BY")
+        sql.append(", ".join(["`%s`%s" % (mappings[k].name, " DESC" if desc else "") for k, desc in order]))
+    if kind == "exists":
+        sql.append("LIMIT 1")
+    elif kind == "select" and limit_form == 1:
+        sql.append("LIMIT ?")
+    elif kind == "select" and limit_form == 2:
+        sql.append("LIMIT ?, ?")
+    return _precompile(" ".join(sql))
+
+
+class Query(object):
+    """
+    Lazy chainable query of model, each method returns a new query.
+    Compiled to sql when awaited or iterated, the statement is cached per query shape.
+    Objects are returned, or read only rows when only() selects columns.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._filters = ()
+        self._wheres = ()
+        self._args = ()
+        self._where_args = ()
+        self._order = ()
+        self._limit = None
+        self._columns = None
+        self._after = None
+
+    def _clone(self, **kw):
+        q = Query.__new__(Query)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(kw)
+        return q
+
+    def _check(self, name):
+        if name not in self.model.__mappings__:
+            raise ValueError("Unknown column of %s: %s" % (self.model.__name__, name))
+
+    def filter(self, **kw):
+        """
+        filter by column values, `name=value` or `name__op=value`, op in eq, ne, gt, gte, lt, lte, in
+        """
+        filters, args = list(self._filters), list(self._args)
+        for key, value in kw.items():
+            name, _, op = key.partition("__")
+            op = op or "eq"
+            self._check(name)
+            if op not in _FILTER_OPERATORS:
+                raise ValueError("Unknown filter operator: %s" % key)
+            if op == "in":
+                value = list(value)
+                if not value:
+                    raise ValueError("Empty values of filter: %s" % key)
+                filters.append((name, op, len(value)))
+                args.extend(value)
+            else:
+                filters.append((name, op, 1))
+                args.append(value)
+        return self._clone(_filters=tuple(filters), _args=tuple(args))
+
+    def where(self, clause, *args):
+        """
+        filter by raw where clause with `?` placeholders
+        """
+        return self._clone(_wheres=self._wheres + (clause,), _where_args=self._where_args + args)
+
+    def order_by(self, *names):
+        """
+        order by columns, `-name` for descending
+        """
+        order = []
+        for name in names:
+            desc = name.startswith("-")
+            name = name.lstrip("-")
+            self._check(name)
+            order.append((name, desc))
+        return self._clone(_order=tuple(order))
+
+    def limit(self, count, offset=None):
+        return self._clone(_limit=count if offset is None else (offset, count))
+
+    def only(self, *names):
+        """
+        select these columns only, results are read only rows
+        """
+        for name in names:
+            self._check(name)
+        return self._clone(_columns=tuple(names))
+
+    def after(self, pk):
+        """
+        keyset pagination, rows after primary key's value ordered by primary key
+        """
+        return self._clone(_after=pk)
+
+    def _compile(self, kind):
+        filters, args = self._filters, list(self._args)
+        order = self._order
+        if self._after is not None:
+            pk = self.model.__primary_key__
+            if order and order != ((pk, False),):
+                raise ValueError("after() requires ordering by primary key")
+            filters += ((pk, "gt", 1),)
+            args.append(self._after)
+            order = ((pk, False),)
+        args.extend(self._where_args)
+        limit_form = _limit_args(self._limit, args) if kind == "select" else None
+        return _query_sql(self.model, kind, filters, self._wheres, order, limit_form, self._columns), args
+
+    def _build(self, rs):
+        if self._columns is None:
+            return [self.model(**r) for r in rs]
+        row_class = _row_class(self.model, self._columns)
+        return [row_class(*r) for r in rs]
+
+    async def all(self):
+        sql, args = self._compile("select")
+        return self._build(await select(sql, args, tuples=self._columns is not None))
+
+    async def first(self):
+        rs = await self.limit(1).all()
+        return rs[0] if rs else None
+
+    async def count(self):
+        sql, args = self._compile("count")
+        rs = await select(sql, args)
+        return rs[0]["_num_"] if rs else 0
+
+    async def exists(self):
+        sql, args = self._compile("exists")
+        return len(await select(sql, args, 1)) > 0
+
+    def __await__(self):
+        return self.all().__await__()
+
+    async def __aiter__(self):
+        sql, args = self._compile("select")
+        async for rs in select_iter(sql, args, tuples=self._columns is not None):
+            for obj in self._build(rs):
+                yield obj
+
+
+class ModelLoader(object):
+    """
+    Request scoped batch loader, load() calls made in the same event loop tick are sent as one `IN` query
+    and results are kept for the lifetime of the loader.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._futures = {}
+        # (pk, future) of the next batch, and running batch tasks
+        self._pending = []
+        self._tasks = set()
+
+    def load(self, pk):
+        """
+        load object by primary key's value
+        :param pk: primary key's value
+        :return: future of object or None
+        """
+        fut = self._futures.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = loop.create_future()
+            self._futures[pk] = fut
+            if not self._pending:
+                loop.call_soon(self._dispatch)
+            self._pending.append((pk, fut))
+        return fut
+
+    def load_many(self, pks):
+        return asyncio.gather(*[self.load(pk) for pk in pks])
+
+    def clear(self, pk=None):
+        """
+        forget loaded objects, futures of running batches are still resolved
+        """
+        if pk is None:
+            self._futures.clear()
+        else:
+            self._futures.pop(pk, None)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._fetch(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _fetch(self, pending):
+        try:
+            objs = await self.model.find_many([pk for pk, _ in pending])
+        except BaseException as e:
+            for pk, fut in pending:
+                # failed loads are not kept, a later load() retries
+                if self._futures.get(pk) is fut:
+                    del self._futures[pk]
+                if not fut.done():
+                    if isinstance(e, asyncio.CancelledError):
+                        fut.cancel()
+                    else:
+                        fut.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (pk, fut), obj in zip(pending, objs):
+            if not fut.done():
+                fut.set_result(obj)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import importlib
+import logging
+
+import orm
+from config import configs
+
+__author__ = "Vic Yue"
+
+""" schema diff of declared model indexes against the live database, printed as migration statements.
+    python schema.py [--models models] [--drop] [--apply] """
+
+
+async def table_exists(table):
+    if orm.backend().name == "sqlite":
+        rs = await orm.select("SELECT COUNT(1) _num_ FROM sqlite_master WHERE `type`='table' AND `name`=?", [table],
+                              primary=True)
+    else:
+        rs = await orm.select("SELECT COUNT(1) _num_ FROM information_schema.TABLES "
+                              "WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=?", [table], primary=True)
+    return bool(rs[0]["_num_"])
+
+
+async def live_indexes(table):
+    """
+    secondary indexes of a live table, primary key excluded
+    :return: list of named orm.Index
+    """
+    indexes = []
+    if orm.backend().name == "sqlite":
+        for r in await orm.select("SELECT `name`, `unique`, `origin` FROM pragma_index_list(?)", [table],
+                                  primary=True):
+            if r["origin"] == "pk":
+                continue
+            columns = await orm.select("SELECT `name` FROM pragma_index_info(?) ORDER BY `seqno`", [r["name"]],
+                                       primary=True)
+            indexes.append(orm.Index(*[c["name"] for c in columns], unique=bool(r["unique"]), name=r["name"]))
+        return indexes
+    rs = await orm.select("SELECT `INDEX_NAME` `name`, `COLUMN_NAME` `column`, `NON_UNIQUE` `non_unique` "
+                          "FROM information_schema.STATISTICS WHERE `TABLE_SCHEMA`=DATABASE() AND `TABLE_NAME`=? "
+                          "ORDER BY `INDEX_NAME`, `SEQ_IN_INDEX`", [table], primary=True)
+    columns = {}
+    for r in rs:
+        if r["name"] != "PRIMARY":
+            columns.setdefault((r["name"], not r["non_unique"]), []).append(r["column"])
+    return [orm.Index(*cols, unique=unique, name=name) for (name, unique), cols in columns.items()]
+
+
+def diff(declared, live):
+    """
+    compare indexes by columns and uniqueness, names are ignored
+    :return: (declared indexes missing in live, live indexes not declared)
+    """
+    return [i for i in declared if i not in live], [i for i in live if i not in declared]
+
+
+def redundant(indexes):
+    """
+    non unique indexes whose columns are a left prefix of another index, the longer one serves their queries
+    :return: list of (index, covering index)
+    """
+    ret = []
+    for index in indexes:
+        for other in indexes:
+            if other is not index and not index.unique and len(other.columns) > len(index.columns) \
+                    and other.columns[:len(index.columns)] == index.columns:
+                ret.append((index, other))
+                break
+    return ret
+
+
+def _columns(index):
+    return ", ".join("`%s`" % c for c in index.columns)
+
+
+def migration(table, add, extra, drop=False):
+    """
+    statements adding missing indexes and dropping undeclared ones when drop is set.
+    On mysql they are one ALTER TABLE per table, so the table is rebuilt once.
+    :return: list of sql statements and comments
+    """
+    sql = []
+    if not drop:
+        sql.extend("-- undeclared index of %s: %s (%s)" % (table, i.name, _columns(i)) for i in extra)
+        extra = []
+    if orm.backend().name == "sqlite":
+        sql.extend("DROP INDEX `%s`;" % i.name for i in extra)
+        sql.extend(orm._create_index_sql(table, i) for i in add)
+        return sql
+    clauses = ["DROP INDEX `%s`" % i.name for i in extra]
+    clauses.extend("ADD %sINDEX `%s` (%s)" % ("UNIQUE " if i.unique else "", i.name, _columns(i)) for i in add)
+    if clauses:
+        sql.append("ALTER TABLE `%s`\n  %s;" % (table, ",\n  ".join(clauses)))
+    return sql
+
+
+def models_of(module_names):
+    """
+    :return: Model classes defined in modules
+    """
+    models = []
+    for name in module_names:
+        mod = importlib.import_module(name)
+        for attr in dir(mod):
+            cls = getattr(mod, attr)
+            if isinstance(cls, type) and issubclass(cls, orm.Model) and cls is not orm.Model \
+                    and cls.__module__ == mod.__name__:
+                models.append(cls)
+    return models
+
+
+async def schema_diff(models, drop=False):
+    """
+    :return: migration statements of models, CREATE TABLE for missing tables
+    """
+    sql = []
+    for model in models:
+        table = model.__table__
+        for index, other in redundant(model.__indexes__):
+            sql.append("-- index %s of %s is a prefix of %s" % (index.name, table, other.name))
+        if not await table_exists(table):
+            sql.append(orm._gen_sql(table, model.__mappings__, rebuild=False, indexes=model.__indexes__))
+            continue
+        add, extra = diff(model.__indexes__, await live_indexes(table))
+        sql.extend(migration(table, add, extra, drop))
+    return sql
+
+
+async def main(module_names, drop, apply):
+    c = configs.db
+    await orm.create_connection_pool(asyncio.get_running_loop(), backend=c.backend, path=c.path, user=c.user,
+                                     password=c.password, db=c.database, host=c.host, port=c.port, maxsize=1)
+    try:
+        sql = await schema_diff(models_of(module_names), drop)
+        print("\n".join(sql) if sql else "-- schema is up to date")
+        if apply:
+            for stmt in sql:
+                if not stmt.startswith("--"):
+                    # CREATE TABLE is followed by its CREATE INDEX statements
+                    for part in stmt.split(";"):
+                        if part.strip():
+                            await orm.execute(part, [])
+    finally:
+        await orm.close_connection_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser(description="diff declared model indexes with the live database")
+    parser.add_argument("--models", default="models", help="comma separated model modules")
+    parser.add_argument("--drop", action="store_true", help="drop undeclared indexes")
+    parser.add_argument("--apply", action="store_true", help="execute the migration")
+    args = parser.parse_args()
+    asyncio.run(main(args.models.split(","), args.drop, args.apply))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import contextvars
+import cProfile
+import functools
+import heapq
+import itertools
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+
+__author__ = "Vic Yue"
+
+""" request scoped trace spans, Server-Timing header and sampling profiler of the slowest requests """
+
+# expose recent traces on debug endpoint
+debug = False
+_recent = collections.deque(maxlen=100)
+_trace = contextvars.ContextVar("trace", default=None)
+profiler = None
+
+_WHITESPACE = re.compile(r"\s+")
+_PLACEHOLDERS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS = re.compile(r"(\(\?\.\.\.\))(?:\s*,\s*\(\?\.\.\.\))+")
+
+
+@functools.lru_cache(maxsize=1024)
+def sql_shape(sql):
+    """
+    normalize statement, placeholder lists of IN and multi-row VALUES are collapsed,
+    so statements differing only by argument count have the same shape
+    :param sql: sql statement with ? placeholders
+    :return: str
+    """
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    return _ROWS.sub(r"\1, ...", _PLACEHOLDERS.sub("(?...)", sql))
+
+
+class Trace(object):
+    """
+    Spans of one request, each span is (name, detail, start offset, duration) in seconds
+    """
+    __slots__ = ("method", "path", "route", "status", "start", "duration", "spans")
+
+    def __init__(self, method, path, route=None):
+        self.method = method
+        self.path = path
+        self.route = route
+        self.status = None
+        self.start = time.monotonic()
+        self.duration = None
+        self.spans = []
+
+    def add(self, name, elapsed, detail=None):
+        self.spans.append((name, detail, time.monotonic() - elapsed - self.start, elapsed))
+
+    def totals(self):
+        """
+        :return: ordered dict of span name -> [seconds, count]
+        """
+        totals = collections.OrderedDict()
+        for name, _, _, elapsed in self.spans:
+            total = totals.get(name)
+            if total is None:
+                total = totals[name] = [0.0, 0]
+            total[0] += elapsed
+            total[1] += 1
+        return totals
+
+    def server_timing(self):
+        """
+        :return: Server-Timing header value of span totals and request total
+        """
+        metrics = []
+        for name, (elapsed, count) in self.totals().items():
+            if count > 1:
+                metrics.append('%s;dur=%.3f;desc="%s calls"' % (name, elapsed * 1000, count))
+            else:
+                metrics.append("%s;dur=%.3f" % (name, elapsed * 1000))
+        metrics.append("total;dur=%.3f" % ((time.monotonic() - self.start) * 1000))
+        return ", ".join(metrics)
+
+    def to_dict(self):
+        return dict(method=self.method, path=self.path, route=self.route, status=self.status,
+                    duration_ms=round((self.duration or 0.0) * 1000, 3),
+                    spans=[dict(name=name, detail=sql_shape(detail) if name == "sql" else detail,
+                                start_ms=round(start * 1000, 3), duration_ms=round(elapsed * 1000, 3))
+                           for name, detail, start, elapsed in self.spans])
+
+
+def start(method, path, route=None):
+    """
+    start trace of current context (request task)
+    :return: Trace
+    """
+    trace = Trace(method, path, route)
+    _trace.set(trace)
+    return trace
+
+
+def current():
+    return _trace.get()
+
+
+def record(name, elapsed, detail=None):
+    """
+    add span to trace of current context, no-op without trace
+    :param name: span name, e.g. handler, sql, acquire, render
+    :param elapsed: seconds
+    :param detail: sql statement, template or pool name
+    """
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, elapsed, detail)
+
+
+def finish(trace, status):
+    trace.status = status
+    trace.duration = time.monotonic() - trace.start
+    if debug:
+        _recent.append(trace)
+
+
+def recent():
+    """
+    :return: recent traces, newest first
+    """
+    return [t.to_dict() for t in reversed(_recent)]
+
+
+class Profiler(object):
+    """
+    Sampling cProfile of requests, keeps the profiles of the slowest N requests per route.
+    Only one request is profiled at a time, other tasks running on the loop while it awaits are counted as well.
+    """
+
+    def __init__(self, rate=0.01, top=10, directory=None):
+        self.rate = rate
+        self.top = top
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "awesome-profiles-%s" % os.getpid())
+        self._active = False
+        # route -> heap of (duration, profile file)
+        self._slowest = {}
+        self._seq = itertools.count()
+
+    def sample(self):
+        return not self._active and random.random() < self.rate
+
+    async def run(self, route, handler, request):
+        """
+        call handler under profiler, the profile is kept when it is among the slowest of route
+        """
+        profile = cProfile.Profile()
+        self._active = True
+        start = time.monotonic()
+        profile.enable()
+        try:
+            return await handler(request)
+        finally:
+            profile.disable()
+            self._active = False
+            self._keep(route, time.monotonic() - start, profile)
+
+    def _keep(self, route, elapsed, profile):
+        heap = self._slowest.setdefault(route, [])
+        if len(heap) >= self.top and elapsed <= heap[0][0]:
+            return
+        name = re.sub(r"[^\w.-]+", "_", route).strip("_") or "root"
+        os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+        path = os.path.join(self.directory, name, "%010.3fms-%s.prof" % (elapsed * 1000, next(self._seq)))
+        profile.dump_stats(path)
+        if len(heap) >= self.top:
+            _, evicted = heapq.heapreplace(heap, (elapsed, path))
+            try:
+                os.remove(evicted)
+            except OSError:
+                pass
+        else:
+            heapq.heappush(heap, (elapsed, path))
+        logging.debug("kept profile of %s: %s", route, path)
+
+    def slowest(self):
+        """
+        :return: dict of route -> profiles of slowest requests, slowest first
+        """
+        return {route: [dict(duration_ms=round(elapsed * 1000, 3), file=path)
+                        for elapsed, path in sorted(heap, reverse=True)]
+                for route, heap in self._slowest.items()}
+
+
+def setup(recent_size=100, debug_endpoint=False, profile=None):
+    """
+    :param recent_size: number of recent traces kept for debug endpoint
+    :param debug_endpoint: expose recent traces and profiles
+    :param profile: profiler options dict of enabled, rate, top, dir
+    """
+    global _recent, debug, profiler
+    _recent = collections.deque(maxlen=recent_size)
+    debug = debug_endpoint
+    if profile and profile.get("enabled"):
+        profiler = Profiler(profile.get("rate", 0.01), profile.get("top", 10), profile.get("dir"))
+        logging.info("profiling %.1f%% of requests to %s" % (profiler.rate * 100, profiler.directory))
+    else:
+        profiler = None
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import importlib
+import logging
+import time
+
+import metrics
+
+__author__ = "Vic Yue"
+
+""" startup warm-up phases run concurrently, readiness reported once all of them finished and the required ones passed """
+
+PHASE_SECONDS = metrics.Gauge("startup_phase_seconds", "Duration of startup phases.", ("phase",))
+
+# set when warm-up finished without failed required phase, phase name -> seconds, failed phase name -> error
+ready = False
+phases = {}
+failed = {}
+_task = None
+
+
+def mark(phase, seconds):
+    """
+    record duration of a startup phase
+    """
+    phases[phase] = round(seconds, 6)
+    PHASE_SECONDS.set(phase, value=seconds)
+
+
+async def _timed(name, coro):
+    start = time.monotonic()
+    try:
+        return await coro
+    except Exception as e:
+        failed[name] = str(e) or e.__class__.__name__
+        logging.warning("warm-up phase %s failed: %s" % (name, e))
+    finally:
+        mark(name, time.monotonic() - start)
+
+
+async def prime_models(models, limit=1000):
+    """
+    prime find caches of models concurrently
+    :param models: dotted model names, e.g. models.User
+    :param limit: max objects of each model
+    :return: dict of model name -> cached objects
+    """
+    classes = []
+    for name in models:
+        module, _, attr = name.rpartition(".")
+        classes.append(getattr(importlib.import_module(module), attr))
+    counts = await asyncio.gather(*[cls.prime_cache(limit=limit) for cls in classes])
+    return dict(zip(models, counts))
+
+
+async def run(phases_coros, started=None, optional=()):
+    """
+    run warm-up phases concurrently, then mark ready and log phase timings.
+    A failed required phase keeps the server not ready, failures of optional phases are only logged.
+    :param phases_coros: dict of phase name -> coroutine
+    :param started: monotonic time of process start, for the total startup time
+    :param optional: names of best-effort phases, e.g. template compiling and cache priming
+    """
+    global ready
+    start = time.monotonic()
+    names = list(phases_coros)
+    await asyncio.gather(*[_timed(name, phases_coros[name]) for name in names])
+    mark("warmup", time.monotonic() - start)
+    if started is not None:
+        mark("total", time.monotonic() - started)
+    required = [name for name in failed if name not in optional]
+    if required:
+        logging.error("not ready, required startup phases failed: %s" % ", ".join(required))
+        return
+    ready = True
+    logging.info("ready, startup phases: %s" % ", ".join("%s %.3fs" % (k, v) for k, v in phases.items()))
+
+
+def start(phases_coros, started=None, optional=()):
+    """
+    start warm-up in background, the server accepts requests meanwhile and /ready reports not ready
+    :return: asyncio.Task
+    """
+    global _task, ready
+    ready = False
+    failed.clear()
+    _task = asyncio.ensure_future(run(phases_coros, started, optional))
+    return _task
+
+
+def cancel():
+    """
+    cancel unfinished warm-up, e.g. on shutdown
+    """
+    if _task is not None and not _task.done():
+        _task.cancel()